@@ -2,6 +2,7 @@
 
 import os
 import sys
+import logging
 from pathlib import Path
 
 # 添加脚本目录到Python路径
@@ -16,6 +17,8 @@ except ImportError as e:
     IMPORT_SUCCESS = False
 
 def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     print("PeROS解析工具")
     print("==============")
     
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+ROS bag 公共工具
+
+bag 处理器与 bag 解析器共用的类型存储、bag 格式识别，以及直接从 ROS1 序列化数据中解析常用消息的函数，
+后者只取出需要的字段，不经过 typestore 构造完整的消息对象。
+"""
+
+import os
+import struct
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+from rosbags.typesys import get_typestore, Stores
+
+
+# 类型存储创建开销较大且只读，模块加载时各创建一次，所有 bag 共用
+TYPESTORE_ROS1 = get_typestore(Stores.ROS1_NOETIC)
+TYPESTORE_ROS2 = get_typestore(Stores.ROS2_FOXY)
+
+# ROS1 bag 文件开头的格式标识
+ROS1_BAG_MAGIC = b'#ROSBAG V2.0\n'
+
+# 单文件形式的 ROS2 bag 扩展名 (sqlite3 与 mcap 存储)
+ROS2_BAG_EXTENSIONS = ('.db3', '.mcap')
+
+# ROS1 消息序列化格式中的定长字段 (小端、无对齐填充)
+_ROS1_UINT32 = struct.Struct('<I')
+_ROS1_IMAGE_SIZE = struct.Struct('<II')          # height, width
+_ROS1_IMAGE_TAIL = struct.Struct('<BII')         # is_bigendian, step, len(data)
+_ROS1_CLOUD_SIZE = struct.Struct('<III')         # height, width, len(fields)
+_ROS1_POINT_FIELD = struct.Struct('<IBI')        # offset, datatype, count
+_ROS1_CLOUD_TAIL = struct.Struct('<BIII')        # is_bigendian, point_step, row_step, len(data)
+
+
+def detect_bag_format(bag_path: str) -> Optional[str]:
+    """
+    识别 bag 的格式
+    
+    以 "#ROSBAG V2.0" 开头的文件是 ROS1 bag，其余文件 (如单个 .db3/.mcap) 按 ROS2 bag 处理；
+    目录中包含 metadata.yaml 时是 ROS2 bag。
+    
+    参数:
+        bag_path: bag 文件或目录路径
+        
+    返回:
+        'ros1'、'ros2'，无法识别时返回 None
+    """
+    if os.path.isdir(bag_path):
+        return 'ros2' if os.path.isfile(os.path.join(bag_path, 'metadata.yaml')) else None
+    
+    try:
+        with open(bag_path, 'rb') as f:
+            magic = f.read(len(ROS1_BAG_MAGIC))
+    except OSError:
+        return None
+    return 'ros1' if magic == ROS1_BAG_MAGIC else 'ros2'
+
+
+def is_bag_entry(entry: os.DirEntry) -> bool:
+    """
+    判断目录项是否为待处理的 bag
+    
+    参数:
+        entry: os.scandir 返回的目录项
+        
+    返回:
+        ROS1 的 .bag 文件、ROS2 的 .db3/.mcap 文件或包含 metadata.yaml 的 bag 目录时返回 True
+    """
+    if entry.is_dir():
+        return os.path.isfile(os.path.join(entry.path, 'metadata.yaml'))
+    return entry.name.endswith(('.bag',) + ROS2_BAG_EXTENSIONS) and entry.is_file()
+
+
+def _read_ros1_string(rawdata, offset: int) -> Tuple[str, int]:
+    """读取 ROS1 序列化的字符串，返回 (字符串, 下一个字段的偏移)"""
+    (length,) = _ROS1_UINT32.unpack_from(rawdata, offset)
+    offset += 4
+    return bytes(rawdata[offset:offset + length]).decode(), offset + length
+
+
+def _skip_ros1_header(rawdata) -> int:
+    """跳过 std_msgs/Header (seq, stamp, frame_id)，返回其后第一个字段的偏移"""
+    (frame_id_length,) = _ROS1_UINT32.unpack_from(rawdata, 12)
+    return 16 + frame_id_length
+
+
+def parse_ros1_image(rawdata) -> SimpleNamespace:
+    """
+    直接从 ROS1 序列化数据中解析 sensor_msgs/Image
+    
+    只解析图像处理需要的字段，data 为原始数据上的 memoryview，不复制像素数据。
+    
+    参数:
+        rawdata: ROS1 序列化的消息数据
+        
+    返回:
+        具有 height, width, encoding, is_bigendian, step, data 属性的消息对象
+    """
+    offset = _skip_ros1_header(rawdata)
+    height, width = _ROS1_IMAGE_SIZE.unpack_from(rawdata, offset)
+    encoding, offset = _read_ros1_string(rawdata, offset + _ROS1_IMAGE_SIZE.size)
+    is_bigendian, step, data_length = _ROS1_IMAGE_TAIL.unpack_from(rawdata, offset)
+    offset += _ROS1_IMAGE_TAIL.size
+    return SimpleNamespace(
+        height=height,
+        width=width,
+        encoding=encoding,
+        is_bigendian=is_bigendian,
+        step=step,
+        data=memoryview(rawdata)[offset:offset + data_length]
+    )
+
+
+def parse_ros1_pointcloud2(rawdata) -> SimpleNamespace:
+    """
+    直接从 ROS1 序列化数据中解析 sensor_msgs/PointCloud2
+    
+    只解析点云处理需要的字段，data 为原始数据上的 memoryview，不复制点数据。
+    
+    参数:
+        rawdata: ROS1 序列化的消息数据
+        
+    返回:
+        具有 height, width, fields, is_bigendian, point_step, row_step, data, is_dense 属性的消息对象
+    """
+    offset = _skip_ros1_header(rawdata)
+    height, width, num_fields = _ROS1_CLOUD_SIZE.unpack_from(rawdata, offset)
+    offset += _ROS1_CLOUD_SIZE.size
+    
+    fields = []
+    for _ in range(num_fields):
+        name, offset = _read_ros1_string(rawdata, offset)
+        field_offset, datatype, count = _ROS1_POINT_FIELD.unpack_from(rawdata, offset)
+        offset += _ROS1_POINT_FIELD.size
+        fields.append(SimpleNamespace(name=name, offset=field_offset, datatype=datatype, count=count))
+    
+    is_bigendian, point_step, row_step, data_length = _ROS1_CLOUD_TAIL.unpack_from(rawdata, offset)
+    offset += _ROS1_CLOUD_TAIL.size
+    data = memoryview(rawdata)[offset:offset + data_length]
+    offset += data_length
+    return SimpleNamespace(
+        height=height,
+        width=width,
+        fields=fields,
+        is_bigendian=is_bigendian,
+        point_step=point_step,
+        row_step=row_step,
+        data=data,
+        is_dense=rawdata[offset]
+    )
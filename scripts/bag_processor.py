@@ -6,39 +6,181 @@ ROS Bag 处理器
 点云数据转换为 PCD 格式，图像数据导出为 JPG 文件。
 """
 
+import io
 import os
+import mmap
+import errno
 import json
-import struct
+import logging
+import tarfile
+import queue
+import threading
+from array import array
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import repeat
 import numpy as np
 from tqdm import tqdm
 
 try:
     from rosbags.rosbag1 import Reader as Bag1Reader
     from rosbags.rosbag2 import Reader as Bag2Reader
-    from rosbags.typesys import get_typestore, Stores
-    # 尝试导入 PIL 用于图像处理
-    from PIL import Image as PILImage
-    HAS_PIL = True
+    # 使用 OpenCV 进行图像颜色转换与 JPEG 编码
+    import cv2
 except ImportError as e:
     print("错误：缺少必要的库。")
     print(f"导入错误：{e}")
-    print("请使用以下命令安装：pip install rosbags Pillow")
+    print("请使用以下命令安装：pip install rosbags opencv-python")
     exit(1)
 
+from bag_common import (TYPESTORE_ROS1, TYPESTORE_ROS2, detect_bag_format, is_bag_entry,
+                        parse_ros1_image, parse_ros1_pointcloud2)
+from io_utils import writev_all
+
+# 可选：orjson 序列化 JSON 更快，未安装时使用标准库 json
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# 可选：PyTurboJPEG 直接调用 libjpeg-turbo 编码，未安装时使用 OpenCV
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_BGRA, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
+
+logger = logging.getLogger(__name__)
+
 # 支持的传感器话题类型
-LIDAR_TYPES = [
+LIDAR_TYPES = frozenset({
     'sensor_msgs/msg/PointCloud2',
     'sensor_msgs/PointCloud2'
-]
+})
 
-IMAGE_TYPES = [
+IMAGE_TYPES = frozenset({
     'sensor_msgs/msg/Image',
     'sensor_msgs/Image'
-]
+})
+
+# JPEG 编码质量
+JPEG_QUALITY = 85
+
+# PCD 文件写缓冲区大小
+PCD_WRITE_BUFFER_SIZE = 1 << 20
+
+# ASCII PCD 每次格式化的点数
+PCD_ASCII_CHUNK_POINTS = 1 << 16
+
+# PCD 文件头模板，只有点数 (WIDTH, POINTS) 与数据格式随文件变化
+_PCD_HEADER_TMPL = (
+    b"# .PCD v0.7 - Point Cloud Data file format\n"
+    b"VERSION 0.7\n"
+    b"FIELDS x y z\n"
+    b"SIZE 4 4 4\n"
+    b"TYPE F F F\n"
+    b"COUNT 1 1 1\n"
+    b"WIDTH %d\n"
+    b"HEIGHT 1\n"
+    b"VIEWPOINT 0 0 0 1 0 0 0\n"
+    b"POINTS %d\n"
+    b"DATA %s\n"
+)
+
+# 设置环境变量 PEROS_PCD_DIRECT_IO=1 时二进制 PCD 以 O_DIRECT 绕过页缓存写入
+PCD_DIRECT_IO = os.environ.get('PEROS_PCD_DIRECT_IO') == '1'
+
+# O_DIRECT 写入要求的缓冲区地址、长度与文件偏移对齐粒度
+DIRECT_IO_ALIGNMENT = 4096
+
+# PointCloud2 点布局: (point_step, x_offset, float_dtype, point_dtype)
+PointLayout = Tuple[int, int, np.dtype, Optional[np.dtype]]
+
+# 后台文件写入线程数
+IO_WORKERS = 4
+
+# 后台预读 bag 消息的队列长度上限，实际长度不超过批次大小
+PREFETCH_QUEUE_SIZE = 256
+
+# 后台解码点云与图像的线程数
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+# 最多积压的未完成解码任务数上限，实际数量不超过批次大小
+DECODE_QUEUE_SIZE = 64
+
+# 默认并行处理bag文件的最大进程数，每个进程都会在内存中缓存一个批次的数据
+MAX_BAG_WORKERS = 4
+
+def prefetch(iterable, maxsize: int = PREFETCH_QUEUE_SIZE):
+    """
+    在后台线程中迭代 iterable，通过有界队列预先取出元素
+    
+    用于让 bag 文件的读取与解压和主线程中的消息反序列化重叠。
+    迭代器中的异常会在主线程中重新抛出。生成器结束或被关闭时会等待后台线程退出，
+    此后才能安全地关闭 iterable 底层的读取器。
+    
+    参数:
+        iterable: 要预读的可迭代对象
+        maxsize: 队列中最多缓存的元素数
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+    
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            has_item, item = items.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def ordered_results(tasks, max_pending: int = DECODE_QUEUE_SIZE):
+    """
+    按提交顺序产出后台任务
+    
+    已完成的任务尽早产出；未完成的任务超过 max_pending 个时阻塞等待最早的任务，
+    从而限制积压的解码结果占用的内存。
+    
+    参数:
+        tasks: 产出 (key, future) 的可迭代对象，future 为 None 表示无需等待
+        max_pending: 最多积压的未产出任务数
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(task)
+        while pending and (len(pending) > max_pending or pending[0][1] is None or pending[0][1].done()):
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
 
 def to_timestamp(ns: int) -> float:
     """
@@ -52,196 +194,566 @@ def to_timestamp(ns: int) -> float:
     """
     return ns / 1e9
 
-def write_pcd_file(filepath: str, points: List[float], width: int = 1) -> None:
+# 可以跳过 typestore 直接解析的 ROS1 消息类型
+ROS1_FAST_PARSERS = {
+    **dict.fromkeys(LIDAR_TYPES, parse_ros1_pointcloud2),
+    **dict.fromkeys(IMAGE_TYPES, parse_ros1_image)
+}
+
+def _as_buffer(data):
+    """
+    将消息中的数据字段转换为按字节访问的缓冲区
+    
+    bytes、bytearray、memoryview 与 C 连续的数组直接以视图形式返回，不复制数据，
+    只有非连续数组等无法直接访问的对象才会复制。
+    
+    参数:
+        data: 消息中的数据字段
+        
+    返回:
+        支持缓冲区协议的字节序列
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    if isinstance(data, np.ndarray) and not data.flags['C_CONTIGUOUS']:
+        return data.tobytes()
+    try:
+        return memoryview(data).cast('B')
+    except TypeError:
+        return bytes(data)
+
+def pcd_header(num_points: int, data_type: str) -> bytes:
+    """
+    生成 x, y, z 三个 float32 字段的无序点云 PCD 文件头
+    
+    参数:
+        num_points: 点数
+        data_type: 数据格式，'ascii' 或 'binary'
+        
+    返回:
+        ASCII 编码的文件头
+    """
+    return _PCD_HEADER_TMPL % (num_points, num_points, data_type.encode('ascii'))
+
+def encode_pcd(points: np.ndarray) -> Tuple[bytes, memoryview]:
+    """
+    将点云编码为二进制 PCD 数据
+    
+    参数:
+        points: 点云数据，形状为 (N, 3) 的 float32 数组
+        
+    返回:
+        (文件头, 小端 float32 点数据)，点数据为数组上的视图，不复制
+    """
+    header = pcd_header(points.shape[0], 'binary')
+    return header, memoryview(np.ascontiguousarray(points, dtype='<f4')).cast('B')
+
+def _write_direct(filepath: str, buffers: List[memoryview]) -> bool:
+    """
+    以 O_DIRECT 方式将多个缓冲区写入文件，绕过页缓存
+    
+    数据先复制到按页对齐的匿名映射中并补齐到对齐粒度的整数倍，
+    一次写入后再把文件截断回实际长度。
+    
+    参数:
+        filepath: 输出文件路径
+        buffers: 按字节访问的缓冲区列表
+        
+    返回:
+        是否写入成功；系统或文件系统不支持 O_DIRECT 时返回 False，由调用方改用普通写入
+    """
+    if not hasattr(os, 'O_DIRECT'):
+        return False
+    
+    size = sum(len(buf) for buf in buffers)
+    padded_size = max(-(-size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT, DIRECT_IO_ALIGNMENT)
+    
+    # 匿名映射按页对齐，满足 O_DIRECT 对用户缓冲区地址的要求
+    aligned = mmap.mmap(-1, padded_size)
+    try:
+        position = 0
+        for buf in buffers:
+            aligned[position:position + len(buf)] = buf
+            position += len(buf)
+        
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                return False
+            raise
+        
+        try:
+            with memoryview(aligned) as view:
+                written = 0
+                while written < padded_size:
+                    written += os.write(fd, view[written:])
+            os.ftruncate(fd, size)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                return False
+            raise
+        finally:
+            os.close(fd)
+    finally:
+        aligned.close()
+    return True
+
+def write_pcd_file(filepath: str, points: np.ndarray, binary: bool = True) -> None:
     """
     将点云数据写入 PCD 文件
     
+    输出为无序点云，即 WIDTH 为点数，HEIGHT 为 1。
+    
     参数:
         filepath: 输出文件路径
-        points: 点云数据 [x1, y1, z1, x2, y2, z2, ...]
-        width: 点云宽度
-    """
-    height = len(points) // 3
-    
-    with open(filepath, 'w') as f:
-        # PCD 文件头
-        f.write("# .PCD v0.7 - Point Cloud Data file format\n")
-        f.write("VERSION 0.7\n")
-        f.write("FIELDS x y z\n")
-        f.write("SIZE 4 4 4\n")
-        f.write("TYPE F F F\n")
-        f.write("COUNT 1 1 1\n")
-        f.write(f"WIDTH {height}\n")
-        f.write(f"HEIGHT {width}\n")
-        f.write("VIEWPOINT 0 0 0 1 0 0 0\n")
-        f.write(f"POINTS {height}\n")
-        f.write("DATA ascii\n")
-        
-        # 写入点云数据
-        for i in range(0, len(points), 3):
-            f.write(f"{points[i]:.6f} {points[i+1]:.6f} {points[i+2]:.6f}\n")
-
-def extract_pointcloud2_data(msg) -> List[float]:
+        points: 点云数据，形状为 (N, 3) 的 float32 数组
+        binary: 是否写入二进制格式，为 False 时写入 ASCII 格式
     """
-    从 PointCloud2 消息中提取点云数据
+    if binary:
+        # 二进制格式直接写入小端 float32 数据
+        header, payload = encode_pcd(points)
+        if PCD_DIRECT_IO and _write_direct(filepath, [header, payload]):
+            return
+        if hasattr(os, 'writev'):
+            # 文件头与数据通过一次 writev 系统调用写入
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                writev_all(fd, [header, payload])
+            finally:
+                os.close(fd)
+        else:
+            with open(filepath, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+        return
+    
+    # 文件头与 ASCII 数据行先进入大缓冲区，再成块写入磁盘
+    num_points = points.shape[0]
+    with open(filepath, 'wb', buffering=PCD_WRITE_BUFFER_SIZE) as f:
+        f.write(pcd_header(num_points, 'ascii'))
+        
+        # 按块整体格式化，由 C 实现的 % 运算完成浮点数到文本的转换
+        for start in range(0, num_points, PCD_ASCII_CHUNK_POINTS):
+            chunk = points[start:start + PCD_ASCII_CHUNK_POINTS]
+            f.write((b"%.6f %.6f %.6f\n" * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def get_pointcloud2_layout(msg) -> PointLayout:
+    """
+    解析 PointCloud2 消息的点布局
+    
+    同一连接上所有消息的布局相同，解析结果 (包括结构化 dtype) 可以按连接缓存复用。
     
     参数:
         msg: PointCloud2 消息对象
         
     返回:
-        点云数据列表 [x1, y1, z1, x2, y2, z2, ...]
+        (point_step, x_offset, float_dtype, point_dtype)，float_dtype 为按 is_bigendian 确定字节序的 float32；
+        x, y, z 连续存放且按 4 字节对齐时 point_dtype 为 None，按 float32 矩阵切片解析
     """
-    points = []
-    
-    # 获取字段信息
     fields = {}
     for field in msg.fields:
         fields[field.name] = field.offset
+    point_step = msg.point_step
+    x_offset, y_offset, z_offset = fields.get('x', 0), fields.get('y', 4), fields.get('z', 8)
+    float_dtype = np.dtype('>f4' if getattr(msg, 'is_bigendian', False) else '<f4')
+    
+    # 常见布局 (x, y, z 连续存放且按 4 字节对齐) 无需结构化 dtype
+    if y_offset == x_offset + 4 and z_offset == x_offset + 8 and x_offset % 4 == 0 and point_step % 4 == 0:
+        return point_step, x_offset, float_dtype, None
+    
+    # 其他布局按 point_step 构造结构化 dtype
+    point_dtype = np.dtype({
+        'names': ['x', 'y', 'z'],
+        'formats': [float_dtype] * 3,
+        'offsets': [x_offset, y_offset, z_offset],
+        'itemsize': point_step
+    })
+    return point_step, x_offset, float_dtype, point_dtype
+
+def _extract_packed_xyz(data, num_points: int, point_step: int, x_offset: int, float_dtype: np.dtype) -> np.ndarray:
+    """
+    提取 x, y, z 连续存放的点云坐标
     
+    大多数激光雷达驱动输出的 PointCloud2 中 x, y, z 位于偏移 0, 4, 8，
+    此时可以把整个缓冲区看作 (N, point_step / 4) 的 float32 矩阵，取出三列即可。
+    
+    参数:
+        data: 点云数据缓冲区
+        num_points: 点数
+        point_step: 每个点占用的字节数，需为 4 的倍数
+        x_offset: x 坐标的字节偏移，需为 4 的倍数
+        float_dtype: 数据中 float32 的字节序
+        
+    返回:
+        本机字节序的点云数据数组，形状为 (N, 3)
+    """
+    floats_per_point = point_step // 4
+    x_col = x_offset // 4
+    matrix = np.frombuffer(data, dtype=float_dtype, count=num_points * floats_per_point).reshape(num_points, floats_per_point)
+    return np.ascontiguousarray(matrix[:, x_col:x_col + 3], dtype=np.float32)
+
+def extract_pointcloud2_data(msg, layout: Optional[PointLayout] = None) -> np.ndarray:
+    """
+    从 PointCloud2 消息中提取点云数据
+    
+    参数:
+        msg: PointCloud2 消息对象
+        layout: 预先解析的点布局 (见 get_pointcloud2_layout)，为 None 时从消息中解析
+        
+    返回:
+        点云数据数组，形状为 (N, 3)，每行为 [x, y, z]；is_dense 为 False 时去除含 NaN/Inf 的无效点
+    """
     # 检查是否有点云数据
     msg_data = getattr(msg, 'data', None)
     # 安全检查：使用 size > 0 而不是直接 if 语句以避免 NumPy 数组歧义错误
     if msg_data is None or (hasattr(msg_data, 'size') and msg_data.size == 0) or (not hasattr(msg_data, 'size') and len(msg_data) == 0):
-        return points
+        return np.empty((0, 3), dtype=np.float32)
+    
+    # 获取字段信息
+    if layout is None:
+        layout = get_pointcloud2_layout(msg)
+    point_step, x_offset, float_dtype, point_dtype = layout
         
     # 解析点云数据
-    point_step = msg.point_step
-    row_step = msg.row_step
-    data = bytes(msg_data)
+    data = _as_buffer(msg_data)
     
     # 计算点的数量
     num_points = len(data) // point_step
     
-    # 预编译 struct 格式以提高性能
-    float_struct = struct.Struct('f')
+    if point_dtype is None:
+        # 常见布局直接按 float32 矩阵切片
+        points = _extract_packed_xyz(data, num_points, point_step, x_offset, float_dtype)
+    else:
+        # 其他布局按缓存的结构化 dtype 一次性解析所有点的 x, y, z 坐标
+        cloud = np.frombuffer(data, dtype=point_dtype, count=num_points)
+        points = np.stack([cloud['x'], cloud['y'], cloud['z']], axis=1).astype(np.float32, copy=False)
     
-    for i in range(num_points):
-        offset = i * point_step
+    # 非稠密点云中无效点以 NaN 表示，不写入输出文件
+    if not getattr(msg, 'is_dense', True):
+        points = points[np.isfinite(points).all(axis=1)]
+    
+    return points
+
+def _report_write_error(future: Future) -> None:
+    """打印后台写入任务中的异常"""
+    error = future.exception()
+    if error is not None:
+        logger.error(f"  写入文件失败: {error}")
+
+def submit_write(io_pool: Optional[ThreadPoolExecutor], write_fn, *args) -> Optional[Future]:
+    """
+    将文件写入任务提交到 I/O 线程池，使磁盘写入与消息反序列化重叠
+    
+    参数:
+        io_pool: I/O 线程池，为 None 时在当前线程直接写入
+        write_fn: 写入函数
+        args: 写入函数的参数，提交后调用方不应再修改
         
-        # 提取 x, y, z 坐标
-        x_offset = offset + fields.get('x', 0)
-        y_offset = offset + fields.get('y', 4)
-        z_offset = offset + fields.get('z', 8)
+    返回:
+        后台写入任务；在当前线程直接写入时返回 None
+    """
+    if io_pool is None:
+        write_fn(*args)
+        return None
+    future = io_pool.submit(write_fn, *args)
+    future.add_done_callback(_report_write_error)
+    return future
+
+def count_completed_writes(futures: List[Optional[Future]]) -> int:
+    """
+    等待写入任务全部完成，并统计成功写入的文件数
+    
+    参数:
+        futures: submit_write 返回的任务列表，None 表示已在当前线程写入
         
-        # 解析浮点数
-        if x_offset + 4 <= len(data):
-            x = float_struct.unpack(data[x_offset:x_offset+4])[0]
-            y = float_struct.unpack(data[y_offset:y_offset+4])[0]
-            z = float_struct.unpack(data[z_offset:z_offset+4])[0]
-            points.extend([x, y, z])
+    返回:
+        成功写入的文件数
+    """
+    wait([f for f in futures if f is not None])
+    return sum(1 for f in futures if f is None or f.exception() is None)
+
+def write_pcd_from_msg(filepath: str, msg, layout: Optional[PointLayout] = None,
+                       io_pool: Optional[ThreadPoolExecutor] = None) -> int:
+    """
+    从 PointCloud2 消息中提取点云并直接写入 PCD 文件
     
-    return points
+    参数:
+        filepath: 输出文件路径
+        msg: PointCloud2 消息对象
+        layout: 预先解析的点布局，为 None 时从消息中解析
+        io_pool: I/O 线程池，提供时点云在当前线程提取后交给后台线程写入
+        
+    返回:
+        写入的点数，没有点云数据时不创建文件并返回 0
+    """
+    points = extract_pointcloud2_data(msg, layout)
+    if points.size == 0:
+        return 0
+    submit_write(io_pool, write_pcd_file, filepath, points)
+    return len(points)
+
+def make_image_decoder(msg) -> Optional[Callable[[object], np.ndarray]]:
+    """
+    根据图像消息的编码与尺寸生成专用的解码函数
+    
+    同一连接上图像的编码与尺寸不变，生成的解码函数可以按连接缓存复用，
+    解码时不再逐条消息判断编码格式。
+    
+    参数:
+        msg: ROS 图像消息
+        
+    返回:
+        接收图像数据缓冲区、返回 OpenCV 通道顺序 uint8 图像数组的函数，图像参数无效时返回 None
+    """
+    # 获取图像属性
+    width = getattr(msg, 'width', 0)
+    height = getattr(msg, 'height', 0)
+    encoding = getattr(msg, 'encoding', 'unknown')
+    
+    # 检查必要参数
+    if width <= 0 or height <= 0:
+        logger.warning(f"  图像参数无效: width={width}, height={height}")
+        return None
+    
+    num_pixels = width * height
+    conversion = None
+    
+    # 根据编码格式确定像素布局
+    if encoding in ('rgb8', 'bgr8'):
+        # RGB 或 BGR 格式图像
+        shape, num_bytes = (height, width, 3), num_pixels * 3
+        if encoding == 'rgb8':
+            conversion = cv2.COLOR_RGB2BGR
+    elif encoding in ('rgba8', 'bgra8'):
+        # RGBA 或 BGRA 格式图像
+        shape, num_bytes = (height, width, 4), num_pixels * 4
+        if encoding == 'rgba8':
+            conversion = cv2.COLOR_RGBA2BGRA
+    elif encoding == 'mono16':
+        # 16 位灰度图像，JPEG 只支持 8 位，保留高 8 位
+        def decode_mono16(msg_data) -> np.ndarray:
+            pixels = np.frombuffer(_as_buffer(msg_data), dtype='<u2', count=num_pixels)
+            return (pixels.reshape(height, width) >> 8).astype(np.uint8)
+        return decode_mono16
+    else:
+        # mono8 为单通道灰度图像；Bayer 格式简化处理为灰度图；其他编码格式尝试按灰度图处理
+        if encoding != 'mono8' and not encoding.startswith('bayer_'):
+            logger.warning(f"  未知的图像编码格式: {encoding}，尝试按灰度图处理")
+        shape, num_bytes = (height, width), num_pixels
+    
+    def decode(msg_data) -> np.ndarray:
+        # 直接在原始缓冲区上构造数组视图，避免复制整幅图像
+        image = np.frombuffer(_as_buffer(msg_data), dtype=np.uint8, count=num_bytes).reshape(shape)
+        if conversion is not None:
+            image = cv2.cvtColor(image, conversion)
+        return image
+    
+    return decode
 
-def save_image_to_memory(msg) -> Optional[PILImage.Image]:
+def save_image_to_memory(msg, decoder: Optional[Callable[[object], np.ndarray]] = None) -> Optional[np.ndarray]:
     """
     将 ROS 图像消息保存到内存中
     
     参数:
         msg: ROS 图像消息
+        decoder: 预先生成的解码函数 (见 make_image_decoder)，为 None 时从消息中生成
         
     返回:
-        PIL Image 对象，如果失败则返回 None
+        OpenCV 通道顺序 (BGR、BGRA 或灰度) 的 uint8 图像数组，如果失败则返回 None
     """
     try:
-        # 获取图像属性
-        width = getattr(msg, 'width', 0)
-        height = getattr(msg, 'height', 0)
-        encoding = getattr(msg, 'encoding', 'unknown')
-        msg_data = getattr(msg, 'data', None)
+        if decoder is None:
+            decoder = make_image_decoder(msg)
+            if decoder is None:
+                return None
         
-        # 检查必要参数
-        if width <= 0 or height <= 0 or msg_data is None:
-            print(f"  图像参数无效: width={width}, height={height}")
-            return None
-            
-        # 安全检查数据大小
-        data_size = 0
-        if hasattr(msg_data, 'size'):
-            data_size = msg_data.size
-        else:
-            data_size = len(msg_data)
-            
-        if data_size == 0:
-            print("  图像数据为空")
+        msg_data = getattr(msg, 'data', None)
+        if msg_data is None or len(msg_data) == 0:
+            logger.debug("  图像数据为空")
             return None
-            
-        # 转换为字节
-        data = bytes(msg_data)
-        
-        # 根据编码格式处理图像
-        if encoding in ['rgb8', 'bgr8']:
-            # RGB 或 BGR 格式图像
-            # 创建 PIL 图像对象
-            if encoding == 'rgb8':
-                image = PILImage.frombuffer('RGB', (width, height), data, 'raw', 'RGB', 0, 1)
-            else:  # bgr8
-                image = PILImage.frombuffer('RGB', (width, height), data, 'raw', 'BGR', 0, 1)
-        elif encoding in ['rgba8', 'bgra8']:
-            # RGBA 或 BGRA 格式图像
-            if encoding == 'rgba8':
-                image = PILImage.frombuffer('RGBA', (width, height), data, 'raw', 'RGBA', 0, 1)
-            else:  # bgra8
-                image = PILImage.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-        elif encoding in ['mono8', 'mono16']:
-            # 单通道灰度图像
-            mode = 'L' if encoding == 'mono8' else 'I;16'
-            image = PILImage.frombuffer(mode, (width, height), data, 'raw', mode, 0, 1)
-        elif encoding.startswith('bayer_'):
-            # Bayer 格式图像，需要去马赛克处理
-            # 简化处理：先转换为灰度图
-            image = PILImage.frombuffer('L', (width, height), data, 'raw', 'L', 0, 1)
-        else:
-            # 其他编码格式，尝试按灰度图处理
-            print(f"  未知的图像编码格式: {encoding}，尝试按灰度图处理")
-            image = PILImage.frombuffer('L', (width, height), data, 'raw', 'L', 0, 1)
         
-        return image
+        return decoder(msg_data)
     except Exception as e:
-        print(f"  处理图像时出错: {e}")
+        logger.debug(f"  处理图像时出错: {e}")
         return None
 
-def find_closest_timestamp(target_ts, timestamps):
-    """查找最接近的时间戳"""
-    if not timestamps:
-        return None
-    return min(timestamps, key=lambda x: abs(x - target_ts))
+def encode_jpeg(image: np.ndarray):
+    """
+    将图像编码为 JPEG
+    
+    优先使用 PyTurboJPEG，未安装时使用 OpenCV 编码。
+    
+    参数:
+        image: OpenCV 通道顺序的 uint8 图像数组
+        
+    返回:
+        JPEG 数据，支持缓冲区协议的字节序列
+    """
+    if _turbo_jpeg is not None:
+        if image.ndim == 2:
+            encoded = _turbo_jpeg.encode(image[:, :, None], quality=JPEG_QUALITY,
+                                         pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY)
+        else:
+            pixel_format = TJPF_BGRA if image.shape[2] == 4 else TJPF_BGR
+            encoded = _turbo_jpeg.encode(image, quality=JPEG_QUALITY,
+                                         pixel_format=pixel_format, jpeg_subsample=TJSAMP_420)
+    else:
+        ok, encoded = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        if not ok:
+            raise ValueError("JPEG 编码失败")
+    return encoded
+
+def save_image_file(image: np.ndarray, filepath: str) -> None:
+    """
+    将图像编码为 JPEG 并保存到文件
+    
+    参数:
+        image: OpenCV 通道顺序的 uint8 图像数组
+        filepath: 输出文件路径
+    """
+    encoded = encode_jpeg(image)
+    with open(filepath, 'wb') as f:
+        f.write(encoded)
+
+def new_image_store() -> dict:
+    """
+    创建单个图像话题的内存存储
+    
+    时间戳与图像分别保存在两个平行数组中，时间戳使用紧凑的 int64 数组，
+    便于同步时直接转换为 NumPy 数组。
+    
+    返回:
+        {'ts': 时间戳数组, 'images': 图像列表}
+    """
+    return {'ts': array('q'), 'images': []}
+
+def find_closest_indices(target_timestamps: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+    """
+    为每个目标时间戳查找已排序时间戳数组中最接近的元素下标
+    
+    参数:
+        target_timestamps: 目标时间戳数组
+        timestamps: 已升序排序的非空时间戳数组
+        
+    返回:
+        与 target_timestamps 等长的下标数组，距离相同时取较早的时间戳
+    """
+    if len(timestamps) == 1:
+        return np.zeros(len(target_timestamps), dtype=np.intp)
+    
+    # 二分查找插入位置，再比较左右两个相邻元素
+    right_idx = np.clip(np.searchsorted(timestamps, target_timestamps), 1, len(timestamps) - 1)
+    left_idx = right_idx - 1
+    pick_left = target_timestamps - timestamps[left_idx] <= timestamps[right_idx] - target_timestamps
+    return np.where(pick_left, left_idx, right_idx)
+
+def _encode_pcd_bytes(points: np.ndarray) -> bytes:
+    """将点云编码为完整的二进制 PCD 文件内容"""
+    return b''.join(encode_pcd(points))
 
-def process_synchronized_batch(lidar_data_batch, image_data_batch, lidar_dir, camera_dir, start_index):
+def write_batch_archive(archive_path: str, entries: List[Tuple[str, str, Callable, object]],
+                        io_pool: Optional[ThreadPoolExecutor] = None) -> None:
+    """
+    将一批帧编码后写入单个 tar 归档，并在旁边生成索引文件
+    
+    归档内的成员路径与场景目录结构一致 (lidar/000000.pcd, camera/image/000000.jpg)，
+    解包到场景目录即可得到标注工具所需的文件。索引文件为同名的 .json，
+    记录每帧各文件数据在归档中的字节偏移与长度: {帧序号: {扩展名: [偏移, 长度]}}。
+    
+    参数:
+        archive_path: 输出归档路径
+        entries: [(帧序号, 归档内成员路径, 编码函数, 编码函数参数)]
+        io_pool: 线程池，提供时各帧在后台线程中并行编码
+    """
+    def encode(entry):
+        return entry[2](entry[3])
+    
+    encoded = io_pool.map(encode, entries) if io_pool is not None else map(encode, entries)
+    
+    index = defaultdict(dict)
+    with tarfile.open(archive_path, 'w') as tf:
+        for (frame, name, _, _), data in zip(entries, encoded):
+            data = memoryview(data).cast('B')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+            # 成员数据按块对齐，写入后的位置减去对齐后的长度即为数据起始偏移
+            padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            index[frame][os.path.splitext(name)[1][1:]] = [tf.offset - padded_size, info.size]
+    
+    with open(os.path.splitext(archive_path)[0] + '.json', 'w') as f:
+        json.dump(index, f)
+
+def process_synchronized_batch(lidar_data_batch, image_data_batch, lidar_dir, camera_dir, start_index, io_pool=None,
+                               archive_path: Optional[str] = None):
     """
     处理一批同步的数据并保存到文件
+    
+    传入 io_pool 时本批次的文件在后台线程中并行写入，函数返回前等待全部写入完成，
+    从而限制积压在写入队列中的数据量。
+    传入 archive_path 时整批数据写入单个 tar 归档 (见 write_batch_archive)，不再逐帧创建文件。
+    
+    参数:
+        lidar_data_batch: {timestamp: (N, 3) float32 点云数组}，函数不会修改其中的数组
+        image_data_batch: {topic: {'ts': 时间戳数组, 'images': 图像列表}}
+        lidar_dir: 点云输出目录
+        camera_dir: 相机输出目录
+        start_index: 本批次第一帧的文件序号
+        io_pool: I/O 线程池，为 None 时在当前线程直接写入
+        archive_path: 批次归档路径，为 None 时逐帧写入独立文件
+        
+    返回:
+        (成功写入的点云文件数, 成功写入的图像文件数)
     """
     # 创建图像子目录
     image_subdir = os.path.join(camera_dir, 'image')
     Path(image_subdir).mkdir(parents=True, exist_ok=True)
     
     # 同步这批数据
-    synchronized_batch = []
     lidar_timestamps = sorted(lidar_data_batch.keys())
-    image_topics = list(image_data_batch.keys())
-    image_timestamps_map = {}
+    lidar_ts_arr = np.asarray(lidar_timestamps, dtype=np.int64)
+    synced_images = [{} for _ in lidar_timestamps]
     
-    for topic in image_topics:
-        image_timestamps_map[topic] = sorted(image_data_batch[topic].keys())
-    
-    for i, lidar_ts in enumerate(lidar_timestamps):
-        synced_images = {}
+    # 为每个图像话题一次性找到每帧点云最接近的图像
+    for topic, topic_images in image_data_batch.items():
+        if not topic_images['ts']:
+            continue
         
-        # 为每个图像话题找到最接近的图像
-        for topic in image_topics:
-            if not image_timestamps_map[topic]:
-                continue
-                
-            # 找到最接近的图像时间戳
-            closest_ts = find_closest_timestamp(lidar_ts, image_timestamps_map[topic])
-            if closest_ts:
-                synced_images[topic] = image_data_batch[topic][closest_ts]
+        image_ts_arr = np.frombuffer(topic_images['ts'], dtype=np.int64)
+        order = np.argsort(image_ts_arr, kind='stable')
+        closest = order[find_closest_indices(lidar_ts_arr, image_ts_arr[order])]
+        images = topic_images['images']
+        for i, j in enumerate(closest.tolist()):
+            synced_images[i][topic] = images[j]
+    
+    synchronized_batch = [
+        (lidar_ts, synced_images[i], start_index + i)
+        for i, lidar_ts in enumerate(lidar_timestamps)
+    ]
+    
+    # 归档模式下整批编码后写入单个文件
+    if archive_path is not None:
+        lidar_entries = []
+        image_entries = []
+        for lidar_ts, image_files, index in synchronized_batch:
+            base_filename = f"{index:06d}"
+            if lidar_ts in lidar_data_batch:
+                lidar_entries.append((base_filename, f"lidar/{base_filename}.pcd", _encode_pcd_bytes, lidar_data_batch[lidar_ts]))
+            for image in image_files.values():
+                if image is not None:
+                    image_entries.append((base_filename, f"camera/image/{base_filename}.jpg", encode_jpeg, image))
         
-        # 添加同步数据
-        synchronized_batch.append((lidar_ts, synced_images, start_index + i))
+        try:
+            write_batch_archive(archive_path, lidar_entries + image_entries, io_pool)
+        except Exception as e:
+            logger.error(f"  写入归档失败: {e}")
+            return 0, 0
+        return len(lidar_entries), len(image_entries)
     
     # 保存同步后的数据到文件
-    lidar_saved = 0
-    image_saved = 0
+    lidar_writes = []
+    image_writes = []
     
     for lidar_ts, image_files, index in synchronized_batch:
         # 生成统一的基础文件名（不包含扩展名）
@@ -253,236 +765,375 @@ def process_synchronized_batch(lidar_data_batch, image_data_batch, lidar_dir, ca
             new_lidar_name = f"{base_filename}.pcd"
             new_lidar_path = os.path.join(lidar_dir, new_lidar_name)
             
-            write_pcd_file(new_lidar_path, points)
-            lidar_saved += 1
+            lidar_writes.append(submit_write(io_pool, write_pcd_file, new_lidar_path, points))
         
         # 写入同步后的图像文件
-        for topic, img_info in image_files.items():
-            if 'data' in img_info:
+        for topic, image in image_files.items():
+            if image is not None:
                 new_img_name = f"{base_filename}.jpg"
                 new_img_path = os.path.join(image_subdir, new_img_name)
                 
                 # 保存图像到磁盘
                 try:
-                    img_info['data'].save(new_img_path)
-                    image_saved += 1
+                    image_writes.append(submit_write(io_pool, save_image_file, image, new_img_path))
                 except Exception as e:
-                    print(f"  保存图像失败: {e}")
+                    logger.error(f"  保存图像失败: {e}")
     
-    return lidar_saved, image_saved
+    # 等待本批次写入完成
+    return count_completed_writes(lidar_writes), count_completed_writes(image_writes)
 
-def process_bag_files(input_dir: str, output_base_dir: str, batch_size: int = 100) -> None:
+def write_scene_desc(desc_file: str, scene_info: dict) -> None:
     """
-    处理目录中的所有bag文件，并将提取的数据保存到指定的目录结构中。
+    将场景描述写入 JSON 文件
     
     参数:
-        input_dir: 包含bag文件的输入目录
+        desc_file: 输出文件路径
+        scene_info: 场景描述字典，其中的 datetime 对象会序列化为 ISO 8601 字符串
+    """
+    if HAS_ORJSON:
+        Path(desc_file).write_bytes(orjson.dumps(scene_info, option=orjson.OPT_INDENT_2))
+    else:
+        with open(desc_file, 'w', encoding='utf-8') as f:
+            json.dump(scene_info, f, ensure_ascii=False, indent=2, default=datetime.isoformat)
+
+def _process_one_bag(bag_path: str, output_base_dir: str, batch_size: int = 100, show_progress: bool = True,
+                     archive: bool = False) -> None:
+    """
+    处理单个bag文件，并将提取的数据保存到以时间戳命名的场景目录中。
+    
+    参数:
+        bag_path: bag文件路径
         output_base_dir: 输出数据的基目录
         batch_size: 批处理大小，控制内存使用量
+        show_progress: 是否显示消息处理进度条
+        archive: 是否将每个同步批次写入单个 tar 归档而不是逐帧写入文件
     """
-    # 创建基础输出目录
-    Path(output_base_dir).mkdir(parents=True, exist_ok=True)
+    bag_file = Path(bag_path)
+    logger.info(f"\n正在处理: {bag_file.name}")
     
-    # 获取所有bag文件
-    bag_files = []
-    for file in Path(input_dir).iterdir():
-        if file.is_file() and (file.suffix == '.bag'):
-            bag_files.append(file)
+    # 为每个bag文件创建场景目录，以时间戳命名
+    scene_name = datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + "_" + bag_file.stem
+    scene_dir = os.path.join(output_base_dir, scene_name)
+    lidar_dir = os.path.join(scene_dir, 'lidar')
+    camera_dir = os.path.join(scene_dir, 'camera')
+    label_dir = os.path.join(scene_dir, 'label')
     
-    if not bag_files:
-        print(f"在目录 '{input_dir}' 中未找到任何bag文件")
-        return
+    # 创建必要的目录
+    Path(lidar_dir).mkdir(parents=True, exist_ok=True)
+    Path(camera_dir).mkdir(parents=True, exist_ok=True)
+    Path(label_dir).mkdir(parents=True, exist_ok=True)
     
-    print(f"找到 {len(bag_files)} 个bag文件")
+    # 初始化传感器数据存储（在内存中处理）
+    lidar_data = {}  # {timestamp: (N, 3) float32 点云数组}
+    image_data = defaultdict(new_image_store)  # {topic: {'ts': 时间戳数组, 'images': 图像列表}}
+    camera_topics_seen = set()  # 出现过图像的话题
     
-    # 处理每个bag文件
-    for bag_file in bag_files:
-        print(f"\n正在处理: {bag_file.name}")
-        bag_path = str(bag_file)
+    # 创建图像子目录
+    image_subdir = os.path.join(camera_dir, 'image')
+    Path(image_subdir).mkdir(parents=True, exist_ok=True)
+    
+    # 文件写入交给后台线程，与消息反序列化重叠
+    io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+    # 点云提取与图像解码交给后台线程，与消息反序列化重叠
+    decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+    
+    reader = None
+    messages = None
+    try:
+        # 按文件头或目录结构识别格式后直接打开，不再先试 ROS1 再试 ROS2
+        bag_format = detect_bag_format(bag_path)
+        if bag_format == 'ros1':
+            is_ros1 = True
+            reader_cls = Bag1Reader
+            typestore = TYPESTORE_ROS1
+        elif bag_format == 'ros2':
+            is_ros1 = False
+            reader_cls = Bag2Reader
+            typestore = TYPESTORE_ROS2
+        else:
+            raise ValueError(f"无法识别的bag格式: {bag_path}")
+        # 打开成功后才赋给 reader，finally 中只关闭已打开的读取器
+        bag_reader = reader_cls(bag_path)
+        bag_reader.open()
+        reader = bag_reader
         
-        # 为每个bag文件创建场景目录，以时间戳命名
-        scene_name = datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + "_" + bag_file.stem
-        scene_dir = os.path.join(output_base_dir, scene_name)
-        lidar_dir = os.path.join(scene_dir, 'lidar')
-        camera_dir = os.path.join(scene_dir, 'camera')
-        label_dir = os.path.join(scene_dir, 'label')
+        # 获取消息数量用于进度条
+        total_messages = reader.message_count if hasattr(reader, 'message_count') else 0
         
-        # 创建必要的目录
-        Path(lidar_dir).mkdir(parents=True, exist_ok=True)
-        Path(camera_dir).mkdir(parents=True, exist_ok=True)
-        Path(label_dir).mkdir(parents=True, exist_ok=True)
+        # 处理所有消息，预读的消息数不超过批次大小，在途数据占用的内存与一个批次相当
+        messages = prefetch(reader.messages(), maxsize=min(PREFETCH_QUEUE_SIZE, batch_size))
+        progress_desc = f"处理 {bag_file.name}"
+        progress_bar = tqdm(
+            messages, 
+            total=total_messages if total_messages > 0 else None,
+            desc=progress_desc,
+            unit="msgs",
+            ncols=80,
+            leave=True,
+            mininterval=0.5,
+            disable=not show_progress
+        )
         
-        # 初始化传感器数据存储（在内存中处理）
-        lidar_data = {}  # {timestamp: point_cloud_data}
-        image_data = defaultdict(dict)  # {topic: {timestamp: image_data}}
+        processed_messages = 0
+        batch_index = 0  # 用于文件命名的全局索引
+        lidar_count = 0  # 内存中的点云数量
+        image_count = 0  # 内存中所有话题的图像总数
+        direct_count = 0  # 无图像话题时直接写入的点云文件数，不计入同步帧数
         
-        # 创建图像子目录
-        image_subdir = os.path.join(camera_dir, 'image')
-        Path(image_subdir).mkdir(parents=True, exist_ok=True)
+        # 没有图像话题时无需同步，点云直接从消息写入文件而不在内存中缓存
+        has_images = any(conn.msgtype in IMAGE_TYPES for conn in reader.connections)
+        field_cache = {}  # {connection.id: 点布局}
+        image_decoders = {}  # {connection.id: 图像解码函数}
         
-        try:
-            # 尝试以ROS1 bag格式打开
-            is_ros1 = True
-            try:
-                reader = Bag1Reader(bag_path)
-                reader.open()
-                typestore = get_typestore(Stores.ROS1_NOETIC)
-            except:
-                # 尝试以ROS2 bag格式打开
-                is_ros1 = False
-                reader = Bag2Reader(bag_path)
-                reader.open()
-                typestore = get_typestore(Stores.ROS2_FOXY)
-            
-            # 获取消息数量用于进度条
-            total_messages = reader.message_count if hasattr(reader, 'message_count') else 0
-            
-            # 处理所有消息
-            progress_desc = f"处理 {bag_file.name}"
-            progress_bar = tqdm(
-                reader.messages(), 
-                total=total_messages if total_messages > 0 else None,
-                desc=progress_desc,
-                unit="msgs",
-                ncols=80,
-                leave=True
-            )
-            
-            processed_messages = 0
-            batch_index = 0  # 用于文件命名的全局索引
-            
+        def batch_archive_path(start_index: int) -> Optional[str]:
+            """归档模式下返回以批次首帧序号命名的归档路径"""
+            return os.path.join(scene_dir, f"batch_{start_index:06d}.tar") if archive else None
+        
+        # 根据格式选择一次反序列化方法，避免在循环中重复判断
+        deserialize = typestore.deserialize_ros1 if is_ros1 else typestore.deserialize_cdr
+        # ROS1 的点云与图像消息直接从原始数据中解析，不经过 typestore 构造完整消息
+        fast_parsers = ROS1_FAST_PARSERS if is_ros1 else {}
+        
+        def submit_decodes():
+            """反序列化消息，并将点云与图像解码提交到后台线程，产出 ((类型, 时间戳, 话题, 消息), future)"""
+            last_topic = None
             for connection, timestamp, rawdata in progress_bar:
+                topic = connection.topic
+                msgtype = connection.msgtype
                 try:
-                    # 更新进度条描述，显示最近处理的话题
-                    progress_bar.set_description(f"处理 {bag_file.name} [{connection.topic}]", refresh=False)
+                    # 话题变化时才更新进度条描述，显示最近处理的话题
+                    if topic != last_topic:
+                        last_topic = topic
+                        progress_bar.set_description(f"处理 {bag_file.name} [{topic}]", refresh=False)
                     
                     # 反序列化消息
-                    if is_ros1:
-                        msg = typestore.deserialize_ros1(rawdata, connection.msgtype)
-                    else:
-                        msg = typestore.deserialize_cdr(rawdata, connection.msgtype)
+                    parse = fast_parsers.get(msgtype)
+                    msg = parse(rawdata) if parse is not None else deserialize(rawdata, msgtype)
                     
                     # 处理激光雷达数据
-                    if connection.msgtype in LIDAR_TYPES:
-                        points = extract_pointcloud2_data(msg)
-                        if points is not None and len(points) > 0:
-                            # 将点云数据存储在内存中而不是立即写入文件
-                            lidar_data[timestamp] = points
+                    if msgtype in LIDAR_TYPES:
+                        # 点布局在同一连接内不变，只在首条消息时解析
+                        layout = field_cache.get(connection.id)
+                        if layout is None:
+                            layout = field_cache[connection.id] = get_pointcloud2_layout(msg)
+                        
+                        if not has_images:
+                            yield ('direct', timestamp, topic, (msg, layout)), None
+                        else:
+                            yield ('lidar', timestamp, topic, None), decode_pool.submit(extract_pointcloud2_data, msg, layout)
                     
                     # 处理图像数据
-                    elif connection.msgtype in IMAGE_TYPES:
-                        # 将图像数据存储在内存中而不是立即写入文件
-                        image = save_image_to_memory(msg)
-                        if image:
-                            image_data[connection.topic][timestamp] = {
-                                'data': image,
-                                'width': getattr(msg, 'width', 0),
-                                'height': getattr(msg, 'height', 0),
-                                'encoding': getattr(msg, 'encoding', 'unknown')
-                            }
+                    elif msgtype in IMAGE_TYPES:
+                        # 编码与尺寸在同一连接内不变，只在首条有效消息时生成解码函数
+                        decoder = image_decoders.get(connection.id)
+                        if decoder is None:
+                            decoder = make_image_decoder(msg)
+                            if decoder is None:
+                                continue
+                            image_decoders[connection.id] = decoder
+                        yield ('image', timestamp, topic, None), decode_pool.submit(save_image_to_memory, msg, decoder)
+                    
+                    else:
+                        yield (None, timestamp, topic, None), None
                 
                 except Exception as e:
                     # 不在进度条中显示错误，避免刷屏
                     continue
-                
-                processed_messages += 1
-                
-                # 检查是否达到批次大小，如果是，则处理当前批次并清空内存
-                if len(lidar_data) >= batch_size or sum(len(imgs) for imgs in image_data.values()) >= batch_size:
-                    if lidar_data and any(image_data.values()):
-                        print(f"  处理批次 (内存中有 {len(lidar_data)} 个点云, {sum(len(imgs) for imgs in image_data.values())} 个图像)")
-                        
-                        # 处理当前批次的同步数据
-                        lidar_saved, image_saved = process_synchronized_batch(
-                            lidar_data.copy(), 
-                            {k: v.copy() for k, v in image_data.items()}, 
-                            lidar_dir, 
-                            camera_dir, 
-                            batch_index
-                        )
-                        
-                        print(f"  批次处理完成: {lidar_saved} 个点云文件和 {image_saved} 个图像文件")
-                        
-                        # 更新全局索引
-                        batch_index += max(len(lidar_data), max([len(imgs) for imgs in image_data.values()] or [0]))
-                        
-                        # 清空内存
-                        lidar_data.clear()
-                        for topic in image_data:
-                            image_data[topic].clear()
-                        
-                        # 显式调用垃圾回收
-                        import gc
-                        gc.collect()
+        
+        # 解码结果按消息原始顺序收集，批次划分与串行处理时一致；积压的解码结果同样不超过批次大小
+        max_pending = min(DECODE_QUEUE_SIZE, batch_size)
+        for (kind, timestamp, topic, msg), future in ordered_results(submit_decodes(), max_pending):
+            try:
+                if kind == 'direct':
+                    filepath = os.path.join(lidar_dir, f"{direct_count:06d}.pcd")
+                    if write_pcd_from_msg(filepath, *msg, io_pool) > 0:
+                        direct_count += 1
+                result = future.result() if future is not None else None
+            except Exception:
+                continue
             
-            # 处理剩余的数据
-            if lidar_data and any(image_data.values()):
-                print(f"  处理最后一批数据 (内存中有 {len(lidar_data)} 个点云, {sum(len(imgs) for imgs in image_data.values())} 个图像)")
-                
-                lidar_saved, image_saved = process_synchronized_batch(
-                    lidar_data, 
-                    image_data, 
-                    lidar_dir, 
-                    camera_dir, 
-                    batch_index
-                )
-                
-                print(f"  最后一批处理完成: {lidar_saved} 个点云文件和 {image_saved} 个图像文件")
+            if kind == 'lidar':
+                if result.size > 0:
+                    # 将点云数据存储在内存中而不是立即写入文件
+                    if timestamp not in lidar_data:
+                        lidar_count += 1
+                    lidar_data[timestamp] = result
             
-            # 如果没有同步数据，但仍需要保存原始数据
-            elif lidar_data or any(image_data.values()):
-                print("  没有同步数据，保存原始数据...")
-                
-                # 按原始顺序保存点云数据
-                for idx, (ts, points) in enumerate(lidar_data.items()):
-                    filename = f"{batch_index + idx:06d}.pcd"
-                    filepath = os.path.join(lidar_dir, filename)
-                    write_pcd_file(filepath, points)
-                
-                # 按原始顺序保存图像数据
-                img_idx = 0
-                for topic_dict in image_data.values():
-                    for ts, img_info in topic_dict.items():
-                        if 'data' in img_info:
-                            new_img_name = f"{batch_index + img_idx:06d}.jpg"
-                            new_img_path = os.path.join(image_subdir, new_img_name)
-                            try:
-                                img_info['data'].save(new_img_path)
-                                img_idx += 1
-                            except Exception as e:
-                                print(f"  保存图像失败: {e}")
+            elif kind == 'image':
+                # 将图像数据存储在内存中而不是立即写入文件
+                if result is not None:
+                    camera_topics_seen.add(topic)
+                    topic_images = image_data[topic]
+                    topic_images['ts'].append(timestamp)
+                    topic_images['images'].append(result)
+                    image_count += 1
             
-            # 创建场景描述文件
-            desc_file = os.path.join(scene_dir, 'desc.json')
-            scene_info = {
-                'scene_name': scene_name,
-                'bag_file': bag_file.name,
-                'processed_date': datetime.now().isoformat(),
-                'lidar_count': processed_messages,  # 这里应该是实际处理的总数
-                'camera_topics': list(image_data.keys()),
-                'synchronized_frames': batch_index  # 实际保存的同步帧数
-            }
+            processed_messages += 1
             
-            with open(desc_file, 'w', encoding='utf-8') as f:
-                json.dump(scene_info, f, ensure_ascii=False, indent=2)
+            # 检查是否达到批次大小，如果是，则处理当前批次并清空内存
+            if lidar_count >= batch_size or image_count >= batch_size:
+                if lidar_count and image_count:
+                    logger.debug(f"  处理批次 (内存中有 {lidar_count} 个点云, {image_count} 个图像)")
+                    
+                    # 直接交出当前批次的容器，随后换用新的空容器，无需复制
+                    batch_lidar, batch_images = lidar_data, image_data
+                    lidar_data = {}
+                    image_data = defaultdict(new_image_store)
+                    lidar_count = image_count = 0
+                    
+                    # 处理当前批次的同步数据
+                    lidar_saved, image_saved = process_synchronized_batch(
+                        batch_lidar, 
+                        batch_images, 
+                        lidar_dir, 
+                        camera_dir, 
+                        batch_index,
+                        io_pool,
+                        batch_archive_path(batch_index)
+                    )
+                    
+                    logger.debug(f"  批次处理完成: {lidar_saved} 个点云文件和 {image_saved} 个图像文件")
+                    
+                    # 更新全局索引
+                    batch_index += max(len(batch_lidar), max([len(imgs['ts']) for imgs in batch_images.values()] or [0]))
+        
+        # 处理剩余的数据
+        if lidar_count and image_count:
+            logger.debug(f"  处理最后一批数据 (内存中有 {lidar_count} 个点云, {image_count} 个图像)")
             
-            print(f"  场景描述已保存: {desc_file}")
-            print(f"  点云数量: {len(lidar_data)}")
-            print(f"  图像话题数量: {len(image_data)}")
-            print(f"  同步帧数: {batch_index}")
+            lidar_saved, image_saved = process_synchronized_batch(
+                lidar_data, 
+                image_data, 
+                lidar_dir, 
+                camera_dir, 
+                batch_index,
+                io_pool,
+                batch_archive_path(batch_index)
+            )
             
-            reader.close()
+            logger.debug(f"  最后一批处理完成: {lidar_saved} 个点云文件和 {image_saved} 个图像文件")
+        
+        # 如果没有同步数据，但仍需要保存原始数据
+        elif lidar_count or image_count:
+            logger.info("  没有同步数据，保存原始数据...")
             
-        except Exception as e:
-            print(f"处理文件 {bag_file.name} 时出错: {e}")
-            if 'reader' in locals():
-                reader.close()
-            continue
+            # 按原始顺序保存点云数据
+            for idx, (ts, points) in enumerate(lidar_data.items()):
+                filename = f"{batch_index + idx:06d}.pcd"
+                filepath = os.path.join(lidar_dir, filename)
+                submit_write(io_pool, write_pcd_file, filepath, points)
+            
+            # 按原始顺序保存图像数据
+            img_idx = 0
+            for topic_images in image_data.values():
+                for image in topic_images['images']:
+                    if image is not None:
+                        new_img_name = f"{batch_index + img_idx:06d}.jpg"
+                        new_img_path = os.path.join(image_subdir, new_img_name)
+                        try:
+                            submit_write(io_pool, save_image_file, image, new_img_path)
+                            img_idx += 1
+                        except Exception as e:
+                            logger.error(f"  保存图像失败: {e}")
+        
+        # 等待所有文件写入完成
+        decode_pool.shutdown(wait=True)
+        io_pool.shutdown(wait=True)
+        
+        # 创建场景描述文件
+        desc_file = os.path.join(scene_dir, 'desc.json')
+        scene_info = {
+            'scene_name': scene_name,
+            'bag_file': bag_file.name,
+            'processed_date': datetime.now(),
+            'lidar_count': processed_messages,  # 这里应该是实际处理的总数
+            'camera_topics': sorted(camera_topics_seen),
+            'synchronized_frames': batch_index  # 实际保存的同步帧数
+        }
+        
+        write_scene_desc(desc_file, scene_info)
+        
+        logger.info(f"  场景描述已保存: {desc_file}")
+        logger.info(f"  点云数量: {len(lidar_data)}")
+        logger.info(f"  图像话题数量: {len(camera_topics_seen)}")
+        logger.info(f"  同步帧数: {batch_index}")
+        
+    except Exception as e:
+        logger.error(f"处理文件 {bag_file.name} 时出错: {e}")
+        decode_pool.shutdown(wait=True, cancel_futures=True)
+        io_pool.shutdown(wait=True)
+    finally:
+        # 先关闭预读生成器并等待后台线程退出，再关闭读取器
+        if messages is not None:
+            messages.close()
+        if reader is not None:
+            reader.close()
+
+def _init_worker_logging(level: int) -> None:
+    """
+    在 bag 处理子进程中配置日志
     
-    print(f"\n所有bag文件处理完成，结果保存在: {output_base_dir}")
+    spawn 与 forkserver 方式启动的子进程不继承父进程的日志配置，不配置时各bag的处理日志会丢失。
+    
+    参数:
+        level: 父进程中的有效日志级别
+    """
+    logging.basicConfig(level=level, format='%(message)s')
+
+def process_bag_files(input_dir: str, output_base_dir: str, batch_size: int = 100, max_workers: Optional[int] = None,
+                      archive: bool = False) -> None:
+    """
+    处理目录中的所有bag文件，并将提取的数据保存到指定的目录结构中。
+    
+    参数:
+        input_dir: 包含bag文件的输入目录
+        output_base_dir: 输出数据的基目录
+        batch_size: 批处理大小，控制内存使用量
+        max_workers: 并行处理bag文件的进程数，默认为CPU核数且不超过 MAX_BAG_WORKERS
+        archive: 是否将每个同步批次写入单个 tar 归档 (batch_XXXXXX.tar 与同名索引 .json)，
+            默认逐帧写入标注工具直接读取的独立文件
+    """
+    # 创建基础输出目录
+    Path(output_base_dir).mkdir(parents=True, exist_ok=True)
+    
+    # 获取所有bag：ROS1 的 .bag 文件、ROS2 的 .db3/.mcap 文件与 bag 目录
+    with os.scandir(input_dir) as it:
+        bag_paths = [
+            entry.path for entry in it
+            if is_bag_entry(entry)
+        ]
+    
+    if not bag_paths:
+        logger.warning(f"在目录 '{input_dir}' 中未找到任何bag文件")
+        return
+    
+    logger.info(f"找到 {len(bag_paths)} 个bag文件")
+    
+    # 每个bag文件输出到独立的场景目录，互不依赖，可以多进程并行处理
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, MAX_BAG_WORKERS)
+    max_workers = min(max_workers, len(bag_paths))
+    
+    if max_workers <= 1:
+        for bag_path in bag_paths:
+            _process_one_bag(bag_path, output_base_dir, batch_size, archive=archive)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker_logging,
+                                 initargs=(logger.getEffectiveLevel(),)) as executor:
+            list(tqdm(
+                executor.map(_process_one_bag, bag_paths, repeat(output_base_dir), repeat(batch_size), repeat(False), repeat(archive)),
+                total=len(bag_paths),
+                desc="处理bag文件",
+                unit="bag",
+                ncols=80
+            ))
+    
+    logger.info(f"\n所有bag文件处理完成，结果保存在: {output_base_dir}")
 
 def main():
     """主函数"""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     # 处理data/bags目录中的所有bag文件，设置较小的批次大小以减少内存使用
     process_bag_files('./data/bags', './data', batch_size=50)
 
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+文件写入工具
+
+bag 处理器与点云旋转工具共用的底层文件写入函数。
+"""
+
+import os
+from typing import List
+
+
+def writev_all(fd: int, buffers: List[memoryview]) -> None:
+    """
+    使用 os.writev 将多个缓冲区顺序写入文件描述符，处理部分写入的情况
+    
+    参数:
+        fd: 文件描述符
+        buffers: 按字节访问的缓冲区列表
+    """
+    buffers = [memoryview(buf) for buf in buffers if len(buf) > 0]
+    while buffers:
+        written = os.writev(fd, buffers)
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = buffers[0][written:]
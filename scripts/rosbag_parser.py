@@ -15,16 +15,29 @@ from typing import List, Optional
 from datetime import datetime
 from collections import defaultdict
 
+import numpy as np
+
 try:
     from rosbags.rosbag1 import Reader as Bag1Reader
     from rosbags.rosbag2 import Reader as Bag2Reader
-    from rosbags.typesys import get_typestore, Stores
     # 移除了无法解析的导入，这些类型将在实际使用时通过typestore获取
 except ImportError:
     print("错误：未找到 rosbags 库。")
     print("请使用以下命令安装：pip install rosbags")
     exit(1)
 
+from bag_common import TYPESTORE_ROS1, TYPESTORE_ROS2, detect_bag_format, is_bag_entry, parse_ros1_image
+
+
+# 通用话题文本输出的文件缓冲区大小
+TEXT_WRITE_BUFFER_SIZE = 1 << 20
+
+# 通用话题每累积多少条消息的文本写入一次文件
+GENERIC_FLUSH_MESSAGES = 4096
+
+# 图像时间戳每累积多少个写入一次文件
+TIMESTAMP_BATCH_SIZE = 4096
+
 
 def list_topics(bag_path: str) -> None:
     """
@@ -34,25 +47,18 @@ def list_topics(bag_path: str) -> None:
         bag_path: bag 文件路径
     """
     try:
-        # 首先尝试 ROS1 bag 格式
-        with Bag1Reader(bag_path) as reader:
-            print(f"ROS1 bag 文件: {bag_path}")
-            print("可用话题:")
-            for connection in reader.connections:
-                print(f"  {connection.topic} ({connection.msgtype})")
-            return
-    except Exception:
-        # 尝试 ROS2 bag 格式
-        try:
-            with Bag2Reader(bag_path) as reader:
-                print(f"ROS2 bag 文件: {bag_path}")
-                print("可用话题:")
-                for connection in reader.connections:
-                    print(f"  {connection.topic} ({connection.msgtype})")
-                return
-        except Exception as e:
-            print(f"读取 bag 文件时出错: {e}")
-            return
+        reader, _, is_ros1 = open_bag(bag_path)
+    except Exception as e:
+        print(f"读取 bag 文件时出错: {e}")
+        return
+    
+    try:
+        print(f"{'ROS1' if is_ros1 else 'ROS2'} bag 文件: {bag_path}")
+        print("可用话题:")
+        for connection in reader.connections:
+            print(f"  {connection.topic} ({connection.msgtype})")
+    finally:
+        reader.close()
 
 
 def safe_str(obj):
@@ -71,6 +77,82 @@ def safe_str(obj):
         return "<无法序列化的对象>"
 
 
+def _write_image_summary(msg, write) -> None:
+    """输出图像消息摘要"""
+    write(f"图像宽度: {getattr(msg, 'width', 'N/A')}\n")
+    write(f"图像高度: {getattr(msg, 'height', 'N/A')}\n")
+    write(f"编码格式: {getattr(msg, 'encoding', 'N/A')}\n")
+    write(f"数据大小: {len(getattr(msg, 'data', []))} 字节\n")
+
+
+def _write_imu_summary(msg, write) -> None:
+    """输出 IMU 消息摘要"""
+    orientation = getattr(msg, 'orientation', None)
+    if orientation:
+        write(f"方向: x={orientation.x}, y={orientation.y}, z={orientation.z}, w={orientation.w}\n")
+    angular_velocity = getattr(msg, 'angular_velocity', None)
+    if angular_velocity:
+        write(f"角速度: x={angular_velocity.x}, y={angular_velocity.y}, z={angular_velocity.z}\n")
+    linear_acceleration = getattr(msg, 'linear_acceleration', None)
+    if linear_acceleration:
+        write(f"线性加速度: x={linear_acceleration.x}, y={linear_acceleration.y}, z={linear_acceleration.z}\n")
+
+
+def _write_laserscan_summary(msg, write) -> None:
+    """输出激光扫描消息摘要"""
+    write(f"扫描角度最小值: {getattr(msg, 'angle_min', 'N/A')}\n")
+    write(f"扫描角度最大值: {getattr(msg, 'angle_max', 'N/A')}\n")
+    write(f"角度增量: {getattr(msg, 'angle_increment', 'N/A')}\n")
+    # ranges 可能是列表或 ndarray，统一转为 float32 数组后一次性求极值，忽略 NaN 无效测距
+    ranges = np.asarray(getattr(msg, 'ranges', []), dtype=np.float32)
+    write(f"扫描距离范围: {len(ranges)} 个点\n")
+    if len(ranges):
+        write(f"最小距离: {np.nanmin(ranges):.3f}\n")
+        write(f"最大距离: {np.nanmax(ranges):.3f}\n")
+
+
+def _make_fields_writer():
+    """
+    创建默认处理方式的输出函数，只输出一些关键字段
+    
+    返回:
+        输出函数，同一连接的公开字段只在首条消息时通过反射查找
+    """
+    public_fields = None
+    
+    def write_fields(msg, write) -> None:
+        nonlocal public_fields
+        if public_fields is None:
+            public_fields = tuple(
+                attr for attr in dir(msg)
+                if not attr.startswith('_') and not callable(getattr(msg, attr))
+            )[:10]  # 只显示前10个字段
+        fields = [f"{attr}={safe_str(getattr(msg, attr))}" for attr in public_fields]
+        write(f"消息字段: {', '.join(fields)}\n")
+    
+    return write_fields
+
+
+def _resolve_handler(msgtype: str):
+    """
+    根据消息类型选择摘要输出函数
+    
+    参数:
+        msgtype: 消息类型名称
+        
+    返回:
+        形如 handler(msg, write) 的输出函数
+    """
+    # 对常见消息类型进行特殊处理
+    if 'sensor_msgs/msg/Image' in msgtype or 'sensor_msgs/Image' in msgtype:
+        return _write_image_summary
+    if 'sensor_msgs/msg/Imu' in msgtype or 'sensor_msgs/Imu' in msgtype:
+        return _write_imu_summary
+    if 'sensor_msgs/msg/LaserScan' in msgtype or 'sensor_msgs/LaserScan' in msgtype:
+        return _write_laserscan_summary
+    return _make_fields_writer()
+
+
 def extract_generic_data(typestore, reader, connections, output_dir: str, topic_name: str, is_ros1: bool = True) -> None:
     """
     提取通用话题数据
@@ -86,68 +168,52 @@ def extract_generic_data(typestore, reader, connections, output_dir: str, topic_
     # 将消息保存到文本文件
     output_file = os.path.join(output_dir, f"{topic_name.replace('/', '_')[1:]}.txt")
     count = 0
+    # 每个连接的处理函数在循环前确定，避免逐条消息比较类型字符串
+    handlers = {c.id: _resolve_handler(c.msgtype) for c in connections}
+    
+    # 文本先累积在内存中，每隔 GENERIC_FLUSH_MESSAGES 条消息整体写入一次
+    pending = []
+    write = pending.append
     
-    with open(output_file, 'w') as f:
+    # 根据格式选择反序列化方法，循环内不再重复判断
+    deserialize = typestore.deserialize_ros1 if is_ros1 else typestore.deserialize_cdr
+    
+    with open(output_file, 'w', buffering=TEXT_WRITE_BUFFER_SIZE) as f:
         for connection, timestamp, rawdata in reader.messages(connections=connections):
             try:
-                # 根据格式选择反序列化方法
-                if is_ros1:
-                    msg = typestore.deserialize_ros1(rawdata, connection.msgtype)
-                else:
-                    msg = typestore.deserialize_cdr(rawdata, connection.msgtype)
+                msg = deserialize(rawdata, connection.msgtype)
                 
-                f.write(f"时间戳: {timestamp}\n")
-                f.write(f"消息类型: {connection.msgtype}\n")
+                write(f"时间戳: {timestamp}\n")
+                write(f"消息类型: {connection.msgtype}\n")
+                
+                handlers[connection.id](msg, write)
                 
-                # 对常见消息类型进行特殊处理
-                if 'sensor_msgs/msg/Image' in connection.msgtype or 'sensor_msgs/Image' in connection.msgtype:
-                    f.write(f"图像宽度: {getattr(msg, 'width', 'N/A')}\n")
-                    f.write(f"图像高度: {getattr(msg, 'height', 'N/A')}\n")
-                    f.write(f"编码格式: {getattr(msg, 'encoding', 'N/A')}\n")
-                    f.write(f"数据大小: {len(getattr(msg, 'data', []))} 字节\n")
-                elif 'sensor_msgs/msg/Imu' in connection.msgtype or 'sensor_msgs/Imu' in connection.msgtype:
-                    orientation = getattr(msg, 'orientation', None)
-                    if orientation:
-                        f.write(f"方向: x={orientation.x}, y={orientation.y}, z={orientation.z}, w={orientation.w}\n")
-                    angular_velocity = getattr(msg, 'angular_velocity', None)
-                    if angular_velocity:
-                        f.write(f"角速度: x={angular_velocity.x}, y={angular_velocity.y}, z={angular_velocity.z}\n")
-                    linear_acceleration = getattr(msg, 'linear_acceleration', None)
-                    if linear_acceleration:
-                        f.write(f"线性加速度: x={linear_acceleration.x}, y={linear_acceleration.y}, z={linear_acceleration.z}\n")
-                elif 'sensor_msgs/msg/LaserScan' in connection.msgtype or 'sensor_msgs/LaserScan' in connection.msgtype:
-                    f.write(f"扫描角度最小值: {getattr(msg, 'angle_min', 'N/A')}\n")
-                    f.write(f"扫描角度最大值: {getattr(msg, 'angle_max', 'N/A')}\n")
-                    f.write(f"角度增量: {getattr(msg, 'angle_increment', 'N/A')}\n")
-                    ranges = getattr(msg, 'ranges', [])
-                    f.write(f"扫描距离范围: {len(ranges)} 个点\n")
-                    if ranges:
-                        f.write(f"最小距离: {min(ranges):.3f}\n")
-                        f.write(f"最大距离: {max(ranges):.3f}\n")
-                else:
-                    # 默认处理方式，只输出一些关键字段
-                    fields = []
-                    for attr in dir(msg):
-                        if not attr.startswith('_') and not callable(getattr(msg, attr)):
-                            fields.append(f"{attr}={safe_str(getattr(msg, attr))}")
-                    f.write(f"消息字段: {', '.join(fields[:10])}\n")  # 只显示前10个字段
-                    
             except Exception as e:
-                f.write(f"时间戳: {timestamp}\n")
-                f.write(f"消息类型: {connection.msgtype}\n")
-                f.write(f"解析消息时出错: {e}\n")
-                f.write(f"原始数据大小: {len(rawdata)} 字节\n")
+                write(f"时间戳: {timestamp}\n")
+                write(f"消息类型: {connection.msgtype}\n")
+                write(f"解析消息时出错: {e}\n")
+                write(f"原始数据大小: {len(rawdata)} 字节\n")
             
-            f.write("-" * 50 + "\n")
+            write("-" * 50 + "\n")
             count += 1
+            
+            if count % GENERIC_FLUSH_MESSAGES == 0:
+                f.writelines(pending)
+                pending.clear()
+        
+        f.writelines(pending)
     
     print(f"提取了 {count} 条消息，数据保存到 {output_file}")
 
 
-def extract_image_data(typestore, reader, connections, output_dir: str, topic_name: str, is_ros1: bool = True) -> None:
+def extract_image_data(typestore, reader, connections, output_dir: str, topic_name: str, is_ros1: bool = True,
+                       metadata_every: int = 0) -> None:
     """
     提取图像话题数据
     
+    每帧的时间戳按序号顺序以小端 uint64 写入 {话题}_timestamps.bin，
+    文本元数据只对部分帧输出，其余帧只保存图像数据。
+    
     参数:
         typestore: 类型存储
         reader: Bag 读取器
@@ -155,56 +221,148 @@ def extract_image_data(typestore, reader, connections, output_dir: str, topic_na
         output_dir: 输出目录
         topic_name: 话题名称
         is_ros1: 是否为 ROS1 格式
+        metadata_every: 每隔多少帧输出一次文本元数据，0 表示只输出第一帧
     """
     # 创建图像输出目录（符合 SUSTechPOINTS 要求的目录结构）
     image_dir = os.path.join(output_dir, 'camera', 'image')
     Path(image_dir).mkdir(parents=True, exist_ok=True)
     
-    # 创建元数据文件
-    metadata_file = os.path.join(output_dir, f"{topic_name.replace('/', '_')[1:]}.txt")
+    # 创建元数据文件与时间戳文件
+    topic_stem = topic_name.replace('/', '_')[1:]
+    metadata_file = os.path.join(output_dir, f"{topic_stem}.txt")
+    timestamps_file = os.path.join(output_dir, f"{topic_stem}_timestamps.bin")
     
     count = 0
-    with open(metadata_file, 'w') as meta_f:
-        meta_f.write(f"图像话题: {topic_name}\n")
-        meta_f.write("=" * 50 + "\n")
+    timestamps = []  # 待写入的时间戳，第 i 个对应序号为 i 的图像
+    deserialize_cdr = typestore.deserialize_cdr
+    path_join = os.path.join
+    with open(metadata_file, 'w') as meta_f, open(timestamps_file, 'wb') as ts_f:
+        meta_write = meta_f.write
+        meta_write(f"图像话题: {topic_name}\n")
+        meta_write("=" * 50 + "\n")
         
         for connection, timestamp, rawdata in reader.messages(connections=connections):
+            timestamps.append(timestamp)
             try:
-                # 根据格式选择反序列化方法
+                # ROS1 图像直接从原始数据中解析，ROS2 使用 typestore 反序列化
                 if is_ros1:
-                    msg = typestore.deserialize_ros1(rawdata, connection.msgtype)
+                    msg = parse_ros1_image(rawdata)
+                    width, height, encoding, step, data = msg.width, msg.height, msg.encoding, msg.step, msg.data
                 else:
-                    msg = typestore.deserialize_cdr(rawdata, connection.msgtype)
+                    msg = deserialize_cdr(rawdata, connection.msgtype)
+                    width = getattr(msg, 'width', 'N/A')
+                    height = getattr(msg, 'height', 'N/A')
+                    encoding = getattr(msg, 'encoding', 'N/A')
+                    step = getattr(msg, 'step', 'N/A')
+                    data = memoryview(msg.data).cast('B')
+                
+                write_metadata = count == 0 or (metadata_every > 0 and count % metadata_every == 0)
                 
                 # 写入元数据
-                meta_f.write(f"时间戳: {timestamp}\n")
-                meta_f.write(f"图像宽度: {getattr(msg, 'width', 'N/A')}\n")
-                meta_f.write(f"图像高度: {getattr(msg, 'height', 'N/A')}\n")
-                meta_f.write(f"编码格式: {getattr(msg, 'encoding', 'N/A')}\n")
-                meta_f.write(f"步长: {getattr(msg, 'step', 'N/A')}\n")
-                meta_f.write(f"数据大小: {len(getattr(msg, 'data', []))} 字节\n")
+                if write_metadata:
+                    meta_write(f"时间戳: {timestamp}\n")
+                    meta_write(f"图像宽度: {width}\n")
+                    meta_write(f"图像高度: {height}\n")
+                    meta_write(f"编码格式: {encoding}\n")
+                    meta_write(f"步长: {step}\n")
+                    meta_write(f"数据大小: {len(data)} 字节\n")
                 
                 # 保存图像数据到符合 SUSTechPOINTS 要求的目录结构
                 image_filename = f"image_{count:06d}.bin"
-                image_path = os.path.join(image_dir, image_filename)
+                image_path = path_join(image_dir, image_filename)
                 with open(image_path, 'wb') as img_f:
-                    img_f.write(bytes(msg.data))
+                    img_f.write(data)
                 
-                meta_f.write(f"图像文件: {image_filename}\n")
-                meta_f.write("-" * 50 + "\n")
+                if write_metadata:
+                    meta_write(f"图像文件: {image_filename}\n")
+                    meta_write("-" * 50 + "\n")
                 count += 1
                 
             except Exception as e:
-                meta_f.write(f"时间戳: {timestamp}\n")
-                meta_f.write(f"解析图像消息时出错: {e}\n")
-                meta_f.write(f"原始数据大小: {len(rawdata)} 字节\n")
-                meta_f.write("-" * 50 + "\n")
+                meta_write(f"时间戳: {timestamp}\n")
+                meta_write(f"解析图像消息时出错: {e}\n")
+                meta_write(f"原始数据大小: {len(rawdata)} 字节\n")
+                meta_write("-" * 50 + "\n")
                 count += 1
+            
+            if len(timestamps) >= TIMESTAMP_BATCH_SIZE:
+                ts_f.write(struct.pack(f'<{len(timestamps)}Q', *timestamps))
+                timestamps.clear()
+        
+        ts_f.write(struct.pack(f'<{len(timestamps)}Q', *timestamps))
     
     print(f"提取了 {count} 张图像，元数据保存到 {metadata_file}，图像文件保存到 {image_dir}")
 
 
-def extract_topic_data(bag_path: str, topic_name: str, output_dir: str) -> None:
+def _extract(typestore, reader, connections, output_dir: str, topic_name: str, is_ros1: bool = True,
+             metadata_every: int = 0) -> None:
+    """
+    使用已打开的读取器提取一个话题的数据
+    
+    参数:
+        typestore: 类型存储
+        reader: 已打开的 Bag 读取器
+        connections: 该话题的连接列表
+        output_dir: 保存提取数据的目录
+        topic_name: 话题名称
+        is_ros1: 是否为 ROS1 格式
+        metadata_every: 图像话题每隔多少帧输出一次文本元数据，0 表示只输出第一帧
+    """
+    # 打印话题类型用于调试
+    msgtype = connections[0].msgtype
+    print(f"  话题 '{topic_name}' 类型: {msgtype}")
+    
+    print(f"正在提取话题 '{topic_name}' 的数据...")
+    
+    # 根据消息类型选择处理方法
+    if msgtype == 'sensor_msgs/msg/Image' or msgtype == 'sensor_msgs/Image':
+        extract_image_data(typestore, reader, connections, output_dir, topic_name, is_ros1=is_ros1,
+                           metadata_every=metadata_every)
+    else:
+        extract_generic_data(typestore, reader, connections, output_dir, topic_name, is_ros1=is_ros1)
+
+
+def open_bag(bag_path: str):
+    """
+    按识别出的格式打开 bag 文件
+    
+    参数:
+        bag_path: bag 文件或目录路径
+        
+    返回:
+        (reader, typestore, is_ros1)，reader 已打开，调用方负责关闭
+    """
+    bag_format = detect_bag_format(bag_path)
+    if bag_format == 'ros1':
+        reader = Bag1Reader(bag_path)
+        typestore, is_ros1 = TYPESTORE_ROS1, True
+    elif bag_format == 'ros2':
+        reader = Bag2Reader(bag_path)
+        typestore, is_ros1 = TYPESTORE_ROS2, False
+    else:
+        raise ValueError(f"无法识别的 bag 格式: {bag_path}")
+    
+    reader.open()
+    return reader, typestore, is_ros1
+
+
+def group_connections_by_topic(reader) -> dict:
+    """
+    按话题对读取器中的连接分组，保持话题首次出现的顺序
+    
+    参数:
+        reader: 已打开的 Bag 读取器
+        
+    返回:
+        {话题名称: 连接列表}
+    """
+    topics = {}
+    for connection in reader.connections:
+        topics.setdefault(connection.topic, []).append(connection)
+    return topics
+
+
+def extract_topic_data(bag_path: str, topic_name: str, output_dir: str, metadata_every: int = 0) -> None:
     """
     从 bag 文件中提取指定话题的数据。
     
@@ -212,100 +370,51 @@ def extract_topic_data(bag_path: str, topic_name: str, output_dir: str) -> None:
         bag_path: bag 文件路径
         topic_name: 要提取的话题名称
         output_dir: 保存提取数据的目录
+        metadata_every: 图像话题每隔多少帧输出一次文本元数据，0 表示只输出第一帧
     """
     # 如果目录不存在则创建
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
-    reader = None
     try:
-        # 首先尝试 ROS1 bag 格式
-        reader = Bag1Reader(bag_path)
-        reader.open()
-        # 获取类型存储以反序列化消息
-        typestore = get_typestore(Stores.ROS1_NOETIC)
-        
-        # 查找指定话题的连接
-        connections = [x for x in reader.connections if x.topic == topic_name]
-        if not connections:
-            print(f"在 bag 文件中未找到话题 '{topic_name}'")
-            reader.close()
-            return
-        
-        # 打印话题类型用于调试
-        msgtype = connections[0].msgtype
-        print(f"  话题 '{topic_name}' 类型: {msgtype}")
-        
-        print(f"正在提取话题 '{topic_name}' 的数据...")
-        
-        # 根据消息类型选择处理方法
-        if msgtype == 'sensor_msgs/msg/Image' or msgtype == 'sensor_msgs/Image':
-            extract_image_data(typestore, reader, connections, output_dir, topic_name, is_ros1=True)
-        else:
-            extract_generic_data(typestore, reader, connections, output_dir, topic_name, is_ros1=True)
-        
-        reader.close()
-        return
+        reader, typestore, is_ros1 = open_bag(bag_path)
     except Exception as e:
-        if reader:
-            try:
-                reader.close()
-            except:
-                pass
-        print(f"处理 ROS1 bag 时出错: {e}")
-        
+        print(f"读取 bag 文件时出错: {e}")
+        return
+    
     try:
-        # 尝试 ROS2 bag 格式
-        reader = Bag2Reader(bag_path)
-        reader.open()
-        # 获取类型存储以反序列化消息
-        typestore = get_typestore(Stores.ROS2_FOXY)
-        
         # 查找指定话题的连接
         connections = [x for x in reader.connections if x.topic == topic_name]
         if not connections:
             print(f"在 bag 文件中未找到话题 '{topic_name}'")
-            reader.close()
             return
-            
-        # 打印话题类型用于调试
-        msgtype = connections[0].msgtype
-        print(f"  话题 '{topic_name}' 类型: {msgtype}")
-            
-        print(f"正在提取话题 '{topic_name}' 的数据...")
-        
-        # 根据消息类型选择处理方法
-        if msgtype == 'sensor_msgs/msg/Image' or msgtype == 'sensor_msgs/Image':
-            extract_image_data(typestore, reader, connections, output_dir, topic_name, is_ros1=False)
-        else:
-            extract_generic_data(typestore, reader, connections, output_dir, topic_name, is_ros1=False)
         
-        reader.close()
-        return
+        _extract(typestore, reader, connections, output_dir, topic_name, is_ros1, metadata_every)
     except Exception as e:
-        if reader:
-            try:
-                reader.close()
-            except:
-                pass
-        print(f"处理 ROS2 bag 时出错: {e}")
+        print(f"处理 {'ROS1' if is_ros1 else 'ROS2'} bag 时出错: {e}")
+    finally:
+        reader.close()
 
 
-def batch_process_bags(input_dir: str, output_dir: str) -> None:
+def batch_process_bags(input_dir: str, output_dir: str, metadata_every: int = 0) -> None:
     """
     批量处理目录中的所有 bag 文件，并将提取的数据保存到指定目录。
     
+    每个 bag 文件只打开一次，所有话题复用同一个读取器与类型存储。
+    
     参数:
         input_dir: 包含 bag 文件的输入目录
         output_dir: 输出数据的目录
+        metadata_every: 图像话题每隔多少帧输出一次文本元数据，0 表示只输出第一帧
     """
     # 创建输出目录
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
-    # 获取所有 bag 文件
-    bag_files = []
-    for file in Path(input_dir).iterdir():
-        if file.is_file() and (file.suffix == '.bag'):
-            bag_files.append(file)
+    # 获取所有 bag：ROS1 的 .bag 文件、ROS2 的 .db3/.mcap 文件与 bag 目录
+    with os.scandir(input_dir) as it:
+        bag_files = [
+            Path(entry.path) for entry in it
+            if is_bag_entry(entry)
+        ]
     
     if not bag_files:
         print(f"在目录 '{input_dir}' 中未找到任何 bag 文件")
@@ -323,35 +432,26 @@ def batch_process_bags(input_dir: str, output_dir: str) -> None:
             bag_output_dir = os.path.join(output_dir, bag_file.stem)
             Path(bag_output_dir).mkdir(parents=True, exist_ok=True)
             
-            # 打开 bag 文件并列出所有话题
-            topics = []
-            reader = None
+            # 打开 bag 文件
             try:
-                reader = Bag1Reader(bag_path)
-                reader.open()
-                topics = [(conn.topic, conn.msgtype) for conn in reader.connections]
-                reader.close()
-            except:
-                try:
-                    reader = Bag2Reader(bag_path)
-                    reader.open()
-                    topics = [(conn.topic, conn.msgtype) for conn in reader.connections]
-                    reader.close()
-                except Exception as e:
-                    if reader:
-                        reader.close()
-                    print(f"无法读取文件 {bag_file.name}: {e}")
-                    continue
-            
-            print(f"  找到 {len(topics)} 个话题")
+                reader, typestore, is_ros1 = open_bag(bag_path)
+            except Exception as e:
+                print(f"无法读取文件 {bag_file.name}: {e}")
+                continue
             
-            # 提取每个话题的数据
-            for topic_name, topic_type in topics:
-                try:
-                    print(f"  正在提取话题: {topic_name}")
-                    extract_topic_data(bag_path, topic_name, bag_output_dir)
-                except Exception as e:
-                    print(f"    提取话题 {topic_name} 时出错: {e}")
+            try:
+                topics = group_connections_by_topic(reader)
+                print(f"  找到 {len(topics)} 个话题")
+                
+                # 使用同一个读取器提取每个话题的数据
+                for topic_name, connections in topics.items():
+                    try:
+                        print(f"  正在提取话题: {topic_name}")
+                        _extract(typestore, reader, connections, bag_output_dir, topic_name, is_ros1, metadata_every)
+                    except Exception as e:
+                        print(f"    提取话题 {topic_name} 时出错: {e}")
+            finally:
+                reader.close()
                     
         except Exception as e:
             print(f"处理文件 {bag_file.name} 时出错: {e}")
@@ -364,7 +464,7 @@ def main():
     主函数，解析命令行参数并处理 bag 文件。
     """
     parser = argparse.ArgumentParser(description="解析 ROS bag 文件，为 SUSTechPOINTS 标注工具准备数据")
-    parser.add_argument("bag_file", nargs='?', help="ROS bag 文件路径")
+    parser.add_argument("bag_file", nargs='?', help="ROS1 bag 文件或 ROS2 bag 目录路径")
     parser.add_argument("--list-topics", action="store_true", 
                         help="列出 bag 文件中的所有话题")
     parser.add_argument("--extract-topic", metavar="TOPIC", 
@@ -373,12 +473,14 @@ def main():
                         help="提取数据的输出目录 (默认: ./data/pool)")
     parser.add_argument("--batch-process", action="store_true",
                         help="批量处理 data/bags 目录中的所有 bag 文件")
+    parser.add_argument("--metadata-every", type=int, default=0, metavar="N",
+                        help="图像话题每隔 N 帧输出一次文本元数据 (默认: 0，只输出第一帧)")
     
     args = parser.parse_args()
     
     # 批量处理模式
     if args.batch_process:
-        batch_process_bags("./data/bags", "./data/pool")
+        batch_process_bags("./data/bags", "./data/pool", args.metadata_every)
         return
     
     # 检查是否提供了 bag 文件
@@ -395,7 +497,7 @@ def main():
     if args.list_topics:
         list_topics(args.bag_file)
     elif args.extract_topic:
-        extract_topic_data(args.bag_file, args.extract_topic, args.output_dir)
+        extract_topic_data(args.bag_file, args.extract_topic, args.output_dir, args.metadata_every)
     else:
         # 默认操作：列出话题
         list_topics(args.bag_file)
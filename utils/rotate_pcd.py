@@ -6,18 +6,210 @@
 该脚本能精确保留原始PCD文件的字段信息（如intensity, ring等）。
 """
 
+import io
 import os
+import sys
+import mmap
 import struct
+import warnings
 import numpy as np
+from numpy.lib import recfunctions
 from pathlib import Path
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from tqdm import tqdm
 
+# 添加脚本目录到Python路径，复用其中的公共模块
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+from io_utils import writev_all
+
+# 可选：读取 binary_compressed 格式的PCD文件需要 python-lzf
+try:
+    import lzf
+    HAS_LZF = True
+except ImportError:
+    HAS_LZF = False
+
+
+# 需要解析到 header_info 中的 PCD 头字段
+PCD_HEADER_KEYS = ('FIELDS', 'SIZE', 'TYPE', 'COUNT', 'WIDTH', 'HEIGHT', 'POINTS', 'VIEWPOINT')
+
+# 多进程处理时每次分派给一个进程的PCD文件数
+PCD_CHUNKSIZE = 8
+
+
+def _parse_pcd_header(mm: mmap.mmap) -> Tuple[Dict[str, str], List[str], str, int]:
+    """
+    从映射的PCD文件开头逐行解析文件头
+    
+    参数:
+        mm: PCD文件的内存映射
+        
+    返回:
+        tuple: (header_info, header_lines, data_type, data_offset)
+        - header_info: PCD文件头信息字典
+        - header_lines: PCD文件头原始行列表（包括DATA行）
+        - data_type: DATA行声明的数据格式，如 ascii
+        - data_offset: 点数据在文件中的起始字节偏移，没有DATA行时为 0
+    """
+    header_info = {}
+    header_lines = []
+    
+    while True:
+        raw_line = mm.readline()
+        if not raw_line:
+            # 没有DATA行时按整个文件都是ASCII点数据处理
+            return header_info, header_lines, 'ascii', 0
+        
+        line = raw_line.decode('ascii', errors='replace').rstrip()
+        header_lines.append(line)
+        if line.startswith('DATA'):
+            parts = line.split()
+            return header_info, header_lines, parts[1] if len(parts) > 1 else 'ascii', mm.tell()
+        if line.startswith(PCD_HEADER_KEYS):
+            key = line.split()[0]
+            value = ' '.join(line.split()[1:])
+            header_info[key] = value
+
+
+def _pcd_field_dtype(header_info: Dict[str, str]) -> np.dtype:
+    """
+    根据PCD文件头的 FIELDS/SIZE/TYPE/COUNT 构造单个点的结构化 dtype
+    
+    参数:
+        header_info: PCD文件头信息字典
+        
+    返回:
+        小端字节序、按字段顺序紧密排列的结构化 dtype
+    """
+    fields = header_info.get('FIELDS', 'x y z').split()
+    sizes = header_info.get('SIZE', ' '.join(['4'] * len(fields))).split()
+    types = header_info.get('TYPE', ' '.join(['F'] * len(fields))).split()
+    counts = header_info.get('COUNT', ' '.join(['1'] * len(fields))).split()
+    
+    descr = []
+    for name, size, type_char, count in zip(fields, sizes, types, counts):
+        kind = {'F': 'f', 'I': 'i', 'U': 'u'}[type_char.upper()]
+        count = int(count)
+        descr.append((name, f'<{kind}{size}', (count,)) if count > 1 else (name, f'<{kind}{size}'))
+    return np.dtype(descr)
+
+
+def _pcd_num_points(header_info: Dict[str, str]) -> int:
+    """返回PCD文件头声明的点数，没有 POINTS 时使用 WIDTH * HEIGHT"""
+    if 'POINTS' in header_info:
+        return int(header_info['POINTS'])
+    return int(header_info.get('WIDTH', 0)) * int(header_info.get('HEIGHT', 1))
+
+
+def _to_point_matrix(cloud: np.ndarray) -> np.ndarray:
+    """
+    将结构化点数组转换为 (N, D) 数组
+    
+    所有字段类型相同时返回同类型的视图，否则转换为 float64。
+    """
+    field_types = {cloud.dtype.fields[name][0].base for name in cloud.dtype.names}
+    dtype = field_types.pop() if len(field_types) == 1 else np.float64
+    return recfunctions.structured_to_unstructured(cloud, dtype=dtype)
+
+
+def _read_binary_points(mm: mmap.mmap, data_offset: int, header_info: Dict[str, str]) -> np.ndarray:
+    """
+    以零拷贝方式读取 binary 格式的点数据
+    
+    参数:
+        mm: PCD文件的内存映射
+        data_offset: 点数据的起始字节偏移
+        header_info: PCD文件头信息字典
+        
+    返回:
+        点云数据数组，形状为 (N, D)，所有字段类型相同时为映射上的视图
+    """
+    point_dtype = _pcd_field_dtype(header_info)
+    num_points = min(_pcd_num_points(header_info), (len(mm) - data_offset) // point_dtype.itemsize)
+    cloud = np.frombuffer(mm, dtype=point_dtype, count=num_points, offset=data_offset)
+    return _to_point_matrix(cloud)
+
+
+def _read_binary_compressed_points(payload: bytes, header_info: Dict[str, str]) -> np.ndarray:
+    """
+    读取 binary_compressed 格式的点数据
+    
+    数据为 LZF 压缩的按字段连续存放 (先存所有点的第一个字段，再存第二个字段…) 的点数据，
+    前面是压缩后与压缩前长度两个 uint32。
+    
+    参数:
+        payload: DATA行之后的数据
+        header_info: PCD文件头信息字典
+        
+    返回:
+        点云数据数组，形状为 (N, D)
+    """
+    if not HAS_LZF:
+        raise ImportError("读取 binary_compressed 格式的PCD文件需要 python-lzf，请使用以下命令安装：pip install python-lzf")
+    
+    compressed_size, uncompressed_size = struct.unpack_from('<II', payload, 0)
+    data = lzf.decompress(payload[8:8 + compressed_size], uncompressed_size)
+    
+    point_dtype = _pcd_field_dtype(header_info)
+    num_points = _pcd_num_points(header_info)
+    
+    # 按字段逐列取出，再交织为每个点连续存放的结构化数组
+    cloud = np.empty(num_points, dtype=point_dtype)
+    offset = 0
+    for name in point_dtype.names:
+        field_dtype = point_dtype.fields[name][0]
+        values_per_point = field_dtype.itemsize // field_dtype.base.itemsize
+        column = np.frombuffer(data, dtype=field_dtype.base, count=num_points * values_per_point, offset=offset)
+        cloud[name] = column.reshape(cloud[name].shape)
+        offset += num_points * field_dtype.itemsize
+    return _to_point_matrix(cloud)
+
+
+def _parse_ascii_points_by_line(payload: bytes, num_fields: int, num_points: int = 0) -> np.ndarray:
+    """
+    逐行解析ASCII点数据，用于 np.loadtxt 无法处理的不规则数据
+    
+    字段不足的行用0填充，多余的字段被忽略，无法解析的行被跳过。
+    结果数组按文件头声明的点数预先分配，逐行直接填入。
+    
+    参数:
+        payload: DATA行之后的ASCII点数据
+        num_fields: 字段数
+        num_points: 文件头声明的点数，用于预分配
+        
+    返回:
+        点云数据数组，形状为 (N, num_fields)
+    """
+    # 预先填0，字段不足的行无需再单独补齐；行数不会超过数据中的换行数
+    points = np.zeros((max(min(num_points, payload.count(b'\n') + 1), 1), num_fields))
+    count = 0
+    for line in payload.decode('ascii', errors='replace').splitlines():
+        values = line.split()
+        if not values or values[0].startswith('#'):
+            continue
+        try:
+            point_data = [float(v) for v in values[:num_fields]]
+        except ValueError:
+            continue  # 跳过无效行
+        if count == len(points):
+            # 实际行数超过文件头声明的点数时扩容
+            points = np.concatenate([points, np.zeros_like(points)])
+        points[count, :len(point_data)] = point_data
+        count += 1
+    
+    return points[:count]
+
 
 def read_pcd_file(filepath: str) -> Tuple[np.ndarray, Dict[str, str], List[str]]:
     """
     从PCD文件中读取点云数据
     
+    文件通过 mmap 映射，ASCII点数据交给 np.loadtxt 整体解析，
+    遇到字段数不一致或无效的行时改为逐行解析；binary 点数据直接以
+    np.frombuffer 在映射上构造数组，不做文本解析；binary_compressed 需要 python-lzf。
+    
     参数:
         filepath: PCD文件路径
         
@@ -25,65 +217,45 @@ def read_pcd_file(filepath: str) -> Tuple[np.ndarray, Dict[str, str], List[str]]
         tuple: (points_array, header_info, header_lines)
         - points_array: 点云数据数组，形状为 (N, D)，N为点数，D为维度
         - header_info: PCD文件头信息字典
-        - header_lines: PCD文件头原始行列表（不包括DATA行）
+        - header_lines: PCD文件头原始行列表（包括DATA行）
     """
-    header_info = {}
-    header_lines = []
-    points = []
-    
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-        
-        # 解析头信息
-        data_start_idx = 0
-        for i, line in enumerate(lines):
-            if line.startswith('DATA ascii'):
-                data_start_idx = i + 1
-                header_lines.append(line.rstrip())
-                break
-            elif line.startswith('FIELDS') or line.startswith('SIZE') or line.startswith('TYPE') or \
-                 line.startswith('COUNT') or line.startswith('WIDTH') or line.startswith('HEIGHT') or \
-                 line.startswith('POINTS') or line.startswith('VIEWPOINT'):
-                key = line.split()[0]
-                value = ' '.join(line.split()[1:])
-                header_info[key] = value
-                header_lines.append(line.rstrip())
-            else:
-                header_lines.append(line.rstrip())
-        
-        # 获取字段信息
-        fields = header_info.get('FIELDS', 'x y z').split()
-        num_fields = len(fields)
-
-        # 读取点数据
-        for line in lines[data_start_idx:]:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                values = line.split()
-                # 检查values长度是否至少等于字段数，如果不够，用0填充
-                if len(values) >= num_fields:
-                    try:
-                        point_data = [float(v) for v in values[:num_fields]]
-                        points.append(point_data)
-                    except ValueError:
-                        continue  # 跳过无效行
-                elif len(values) > 0:  # 至少有一个值
-                    try:
-                        # 用0填充缺失的字段
-                        point_data = [float(v) for v in values]
-                        while len(point_data) < num_fields:
-                            point_data.append(0.0)  # 用0填充缺失字段
-                        points.append(point_data)
-                    except ValueError:
-                        continue  # 跳过无效行
-
-    if points:
-        return np.array(points), header_info, header_lines
-    else:
-        return np.empty((0, len(header_info.get('FIELDS', 'x y z').split()))), header_info, header_lines
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.empty((0, 3)), {}, []
+        # 写时复制映射：返回的数组可以原地修改而不影响源文件
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    
+    header_info, header_lines, data_type, data_offset = _parse_pcd_header(mm)
+    num_fields = len(header_info.get('FIELDS', 'x y z').split())
+    
+    if data_type == 'binary':
+        # 数组直接引用映射，映射随数组一起释放
+        return _read_binary_points(mm, data_offset, header_info), header_info, header_lines
+    
+    with mm:
+        payload = mm[data_offset:]
+    
+    if data_type == 'binary_compressed':
+        return _read_binary_compressed_points(payload, header_info), header_info, header_lines
+    if data_type != 'ascii':
+        raise ValueError(f"不支持的PCD数据格式: {data_type}")
+    
+    # 读取点数据
+    try:
+        with warnings.catch_warnings():
+            # 没有点数据时 np.loadtxt 会发出警告，这里按空点云处理
+            warnings.simplefilter('ignore', UserWarning)
+            points = np.loadtxt(io.BytesIO(payload), ndmin=2, usecols=range(num_fields))
+    except ValueError:
+        points = _parse_ascii_points_by_line(payload, num_fields, _pcd_num_points(header_info))
+    
+    if points.size == 0:
+        return np.empty((0, num_fields)), header_info, header_lines
+    return points, header_info, header_lines
 
 
-def write_pcd_file(filepath: str, points: np.ndarray, header_info: Dict[str, str], original_header_lines: List[str]) -> None:
+def write_pcd_file(filepath: str, points: np.ndarray, header_info: Dict[str, str], original_header_lines: List[str],
+                   binary: bool = True) -> None:
     """
     将点云数据写入PCD文件，保留原始头信息
     
@@ -92,6 +264,7 @@ def write_pcd_file(filepath: str, points: np.ndarray, header_info: Dict[str, str
         points: 点云数据数组，形状为 (N, D)，N为点数，D为维度
         header_info: PCD文件头信息
         original_header_lines: 原始头信息行列表
+        binary: 是否按 SIZE/TYPE 声明的字段类型写入 binary 格式，为 False 时写入 ASCII 格式
     """
     if points.size == 0:
         return
@@ -107,61 +280,130 @@ def write_pcd_file(filepath: str, points: np.ndarray, header_info: Dict[str, str
             updated_header_lines.append(f"POINTS {num_points}")
         elif line.startswith('HEIGHT'):
             updated_header_lines.append(f"HEIGHT 1")
+        elif line.startswith('DATA'):
+            # 输出格式与输入无关，由 binary 参数决定
+            updated_header_lines.append("DATA binary" if binary else "DATA ascii")
         else:
             updated_header_lines.append(line)
     
+    if binary:
+        # 按原始字段类型组装结构化数组，整体写入而不做文本格式化
+        cloud = recfunctions.unstructured_to_structured(points, dtype=_pcd_field_dtype(header_info))
+        header = ("\n".join(updated_header_lines) + "\n").encode('ascii')
+        payload = memoryview(cloud.view(np.uint8))
+        if hasattr(os, 'writev'):
+            # 文件头与点数据通过一次 writev 系统调用写入
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                writev_all(fd, [header, payload])
+            finally:
+                os.close(fd)
+        else:
+            with open(filepath, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+        return
+    
     with open(filepath, 'w') as f:
         # 写入更新后的头信息
         for line in updated_header_lines:
             f.write(line + "\n")
         
-        # 写入点云数据
-        for point in points:
-            f.write(" ".join([f"{val:.6f}" for val in point]) + "\n")
+        # 写入点云数据，由 NumPy 整体格式化
+        np.savetxt(f, points, fmt='%.6f', delimiter=' ')
 
 
 def rotate_pcd_by_negating_yz(points: np.ndarray) -> np.ndarray:
     """
-    对点云数据的y,z轴值取反
+    对点云数据的y,z轴值原地取反
     
     参数:
-        points: 原始点云数据数组，形状为 (N, D)，N为点数，D为维度
+        points: 点云数据数组，形状为 (N, D)，N为点数，D为维度，会被直接修改
         
     返回:
-        y,z轴取反后的点云数据数组
+        y,z轴取反后的点云数据数组，即传入的 points
     """
     if points.size == 0:
         return points
     
-    # 复制点云数据以避免修改原始数据
-    result_points = points.copy()
+    # 对y轴和z轴的值一次性原地取反（只有y轴时只取反y轴）
+    yz = points[:, 1:3]
+    np.negative(yz, out=yz)
     
-    # 对y轴和z轴的值取反（假设点云至少有3个维度：x, y, z）
-    if result_points.shape[1] >= 2:  # 有y轴
-        result_points[:, 1] = -result_points[:, 1]  # y轴取反
-    if result_points.shape[1] >= 3:  # 有z轴
-        result_points[:, 2] = -result_points[:, 2]  # z轴取反
+    return points
+
+
+def _prefetch_pcd_file(pcd_path: str) -> None:
+    """
+    提示内核在后台预读PCD文件
+    
+    读取使用 mmap，文件页已在页缓存中时处理过程不再等待磁盘。
+    不支持 posix_fadvise 的平台上不做任何操作。
     
-    return result_points
+    参数:
+        pcd_path: PCD文件路径
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(pcd_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _process_one(pcd_path: str, output_dir: str, binary: bool = True) -> None:
+    """
+    对单个PCD文件的y,z轴值取反并保存到输出目录
+    
+    参数:
+        pcd_path: PCD文件路径
+        output_dir: 输出目录
+        binary: 是否以 binary 格式保存PCD文件，为 False 时保存为 ASCII 格式
+    """
+    pcd_file = Path(pcd_path)
+    try:
+        # 读取原始点云数据
+        points, header_info, original_header_lines = read_pcd_file(str(pcd_file))
+        
+        if points.size == 0:
+            print(f"  警告: {pcd_file.name} 中没有点云数据")
+            return
+        
+        # 对y,z轴值原地取反
+        rotate_pcd_by_negating_yz(points)
+        
+        # 生成输出文件路径
+        output_filepath = os.path.join(output_dir, pcd_file.name)
+        
+        # 保存取反后的点云数据，保留原始头信息
+        write_pcd_file(output_filepath, points, header_info, original_header_lines, binary)
+        
+    except Exception as e:
+        print(f"  处理文件 {pcd_file.name} 时出错: {e}")
 
 
-def process_pcd_files(input_dir: str, output_dir: str) -> None:
+def process_pcd_files(input_dir: str, output_dir: str, binary: bool = True, max_workers: Optional[int] = None) -> None:
     """
     处理目录中的所有PCD文件，绕x轴旋转并保存到新目录
     
     参数:
         input_dir: 包含PCD文件的输入目录
         output_dir: 输出目录
-        angle_degrees: 旋转角度（度），默认180度
+        binary: 是否以 binary 格式保存PCD文件，为 False 时保存为 ASCII 格式
+        max_workers: 并行处理PCD文件的进程数，默认为CPU核数
     """
     # 创建输出目录
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     # 获取所有PCD文件
-    pcd_files = []
-    for file in Path(input_dir).glob('*.pcd'):
-        if file.is_file():
-            pcd_files.append(file)
+    with os.scandir(input_dir) as it:
+        pcd_files = [entry.path for entry in it if entry.name.endswith('.pcd') and entry.is_file()]
     
     if not pcd_files:
         print(f"在目录 '{input_dir}' 中未找到任何PCD文件")
@@ -169,28 +411,29 @@ def process_pcd_files(input_dir: str, output_dir: str) -> None:
     
     print(f"找到 {len(pcd_files)} 个PCD文件")
     
-    # 处理每个PCD文件
-    for pcd_file in tqdm(pcd_files, desc="处理PCD文件"):
-        try:
-            # 读取原始点云数据
-            points, header_info, original_header_lines = read_pcd_file(str(pcd_file))
-            
-            if points.size == 0:
-                print(f"  警告: {pcd_file.name} 中没有点云数据")
-                continue
-            
-            # 对y,z轴值取反
-            negated_points = rotate_pcd_by_negating_yz(points)
-            
-            # 生成输出文件路径
-            output_filepath = os.path.join(output_dir, pcd_file.name)
-            
-            # 保存取反后的点云数据，保留原始头信息
-            write_pcd_file(output_filepath, negated_points, header_info, original_header_lines)
-            
-        except Exception as e:
-            print(f"  处理文件 {pcd_file.name} 时出错: {e}")
-            continue
+    # 每个PCD文件互不依赖，可以多进程并行处理
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(pcd_files))
+    
+    # 提前预读领先于当前进度的若干文件，使磁盘读取与点云处理重叠
+    prefetch_ahead = max_workers * PCD_CHUNKSIZE * 2
+    for pcd_file in pcd_files[:prefetch_ahead]:
+        _prefetch_pcd_file(pcd_file)
+    
+    if max_workers <= 1:
+        results = map(_process_one, pcd_files, repeat(output_dir), repeat(binary))
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        results = executor.map(_process_one, pcd_files, repeat(output_dir), repeat(binary), chunksize=PCD_CHUNKSIZE)
+    
+    try:
+        for i, _ in enumerate(tqdm(results, total=len(pcd_files), desc="处理PCD文件")):
+            if i + prefetch_ahead < len(pcd_files):
+                _prefetch_pcd_file(pcd_files[i + prefetch_ahead])
+    finally:
+        if max_workers > 1:
+            executor.shutdown()
     
     print(f"\n所有PCD文件处理完成，结果保存在: {output_dir}")
 